@@ -0,0 +1,111 @@
+"""
+Micro-benchmark: pgvector text literals vs the binary codecs in main.py.
+
+Measures client-side encode cost and payload size, and, when DATABASE_URL is
+set, insert and top-k query cost against a temporary table for each format.
+
+    cd backend && python benchmarks/vector_codec.py [--rows 2000] [--queries 200]
+
+Prints a JSON report.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+import asyncpg
+import numpy as np
+from dotenv import load_dotenv
+
+from main import EMBEDDING_DIM, encode_vector, encode_halfvec, register_vector_codecs
+
+
+def random_vectors(count: int) -> np.ndarray:
+    vectors = np.random.default_rng(0).standard_normal((count, EMBEDDING_DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def bench_encode(vectors: np.ndarray) -> dict:
+    report = {}
+    for name, encode in (
+        ("text", lambda v: str(v.tolist())),
+        ("binary_vector", encode_vector),
+        ("binary_halfvec", encode_halfvec),
+    ):
+        started = time.perf_counter()
+        payloads = [encode(v) for v in vectors]
+        elapsed = time.perf_counter() - started
+        report[name] = {
+            "us_per_vector": round(elapsed / len(vectors) * 1e6, 2),
+            "bytes_per_vector": round(sum(map(len, payloads)) / len(payloads), 1),
+        }
+    return report
+
+
+async def bench_database(vectors: np.ndarray, queries: np.ndarray) -> dict:
+    report = {}
+    text_conn = await asyncpg.connect(os.environ["DATABASE_URL"])
+    binary_conn = await asyncpg.connect(os.environ["DATABASE_URL"])
+    await register_vector_codecs(binary_conn)
+    has_halfvec = await binary_conn.fetchval("SELECT count(*) FROM pg_type WHERE typname = 'halfvec'") > 0
+
+    cases = [("text", text_conn, "vector", lambda v: str(v.tolist())), ("binary_vector", binary_conn, "vector", lambda v: v)]
+    if has_halfvec:
+        cases.append(("binary_halfvec", binary_conn, "halfvec", lambda v: v))
+
+    try:
+        for name, conn, sql_type, convert in cases:
+            table = f"bench_vectors_{name}"
+            await conn.execute(f"CREATE TEMP TABLE {table} (id INTEGER, embedding {sql_type}({EMBEDDING_DIM}))")
+
+            started = time.perf_counter()
+            await conn.executemany(
+                f"INSERT INTO {table}(id, embedding) VALUES ($1, $2::{sql_type})",
+                [(i, convert(v)) for i, v in enumerate(vectors)]
+            )
+            insert_elapsed = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for q in queries:
+                await conn.fetch(
+                    f"SELECT id FROM {table} ORDER BY embedding <=> $1::{sql_type} LIMIT 10", convert(q)
+                )
+            query_elapsed = time.perf_counter() - started
+
+            started = time.perf_counter()
+            await conn.fetch(f"SELECT embedding FROM {table}")
+            fetch_elapsed = time.perf_counter() - started
+
+            report[name] = {
+                "insert_us_per_row": round(insert_elapsed / len(vectors) * 1e6, 1),
+                "query_ms": round(query_elapsed / len(queries) * 1000, 3),
+                "fetch_all_ms": round(fetch_elapsed * 1000, 1),
+            }
+    finally:
+        await text_conn.close()
+        await binary_conn.close()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    load_dotenv()
+    vectors = random_vectors(args.rows)
+    queries = random_vectors(args.queries)
+    report = {"rows": args.rows, "queries": args.queries, "encode": bench_encode(vectors)}
+    if os.getenv("DATABASE_URL"):
+        report["database"] = asyncio.run(bench_database(vectors, queries))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
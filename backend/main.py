@@ -1,22 +1,41 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, status
+import time
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 import nltk
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
-from bertopic import BERTopic
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import google.generativeai as genai
 import PyPDF2
 from dotenv import load_dotenv
 import asyncpg
+import numpy as np
 import uuid
 import os
 import json
+import asyncio
+import cProfile
+import gc
+import logging
+import random
+import re
+import base64
+import hashlib
+import signal
+import socket
+import struct
+import sys
+import tempfile
 import bcrypt
 import jwt
 from datetime import datetime, timedelta
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple, Iterable, Iterator
 
 # Type hint for the connection pool
 pool: Optional[asyncpg.Pool] = None
@@ -24,8 +43,32 @@ pool: Optional[asyncpg.Pool] = None
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global pool
+    started = time.perf_counter()
     pool = await init_db()  # Startup
+    logger.info("Database pool ready in %.2fs", time.perf_counter() - started)
+    check_sentence_tokenizer()
+    query_batcher.start()
+    query_log.start()
+    job_mirror.start()
+    await start_cache_listener()
+    await start_ingestion()
+    start_concept_maps()
+    # The model loads in the background; /readyz reports 503 until it is in place
+    model_task = asyncio.create_task(load_embedder_async())
+    backfill_task = asyncio.create_task(backfill_document_chunks()) if CHUNK_BACKFILL_ENABLED else None
     yield
+    model_task.cancel()
+    await asyncio.gather(model_task, return_exceptions=True)
+    if backfill_task:
+        backfill_task.cancel()
+        await asyncio.gather(backfill_task, return_exceptions=True)
+    await stop_ingestion()
+    await stop_concept_maps()
+    await query_batcher.stop()
+    await query_log.stop()  # Final flush before the pool closes
+    await job_mirror.stop()
+    await stop_cache_listener()
+    bcrypt_executor.shutdown(wait=False, cancel_futures=True)
     if pool:
         await pool.close()      # Shutdown
 
@@ -40,23 +83,333 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "Retry-After"],
 )
 
 # Configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Pool sizing per process; with WORKERS > 1 the server sees WORKERS * DB_POOL_MAX_SIZE connections
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_MAX_IDLE_SECONDS = float(os.getenv("DB_POOL_MAX_IDLE_SECONDS", "300"))
+# Client-side limit on a single call, and a server-side statement_timeout so runaway queries are cancelled
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "60"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+# Prepared statements cached per connection; set to 0 behind pgbouncer in transaction mode
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 JWT_SECRET = os.getenv("JWT_SECRET")
 JWT_ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# bcrypt cost for new password hashes; existing hashes keep the cost they were made with
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Hash/verify calls queued beyond this are refused with 503 instead of piling up
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", str(BCRYPT_WORKERS * 8)))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", "60"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+# Candidate passages per query; the prompt keeps as many as fit QUERY_CONTEXT_TOKENS
+QUERY_TOP_K_CHUNKS = int(os.getenv("QUERY_TOP_K_CHUNKS", "12"))
+QUERY_CONTEXT_TOKENS = int(os.getenv("QUERY_CONTEXT_TOKENS", "1500"))
+FLASHCARD_CONTEXT_TOKENS = int(os.getenv("FLASHCARD_CONTEXT_TOKENS", "4000"))
+FLASHCARD_SECTION_TOKENS = int(os.getenv("FLASHCARD_SECTION_TOKENS", "3000"))
+FLASHCARD_CONCURRENCY = int(os.getenv("FLASHCARD_CONCURRENCY", "4"))
+FLASHCARD_MAX_RETRIES = int(os.getenv("FLASHCARD_MAX_RETRIES", "2"))
+FLASHCARD_RETRY_BASE_SECONDS = float(os.getenv("FLASHCARD_RETRY_BASE_SECONDS", "1"))
+FLASHCARD_DEDUP_THRESHOLD = float(os.getenv("FLASHCARD_DEDUP_THRESHOLD", "0.9"))
+FLASHCARD_SECTION_CACHE_SIZE = int(os.getenv("FLASHCARD_SECTION_CACHE_SIZE", "512"))
+# Shared Gemini gateway: concurrent calls, tokens per minute (0 = unlimited),
+# callers allowed to wait for a slot, and how long they may wait. The limits are
+# for the whole server; with WORKERS > 1 `serve` gives each worker an even share
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "1000000"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+LLM_MAX_WAIT_SECONDS = float(os.getenv("LLM_MAX_WAIT_SECONDS", "30"))
+# Expected response size, charged against the token budget up front
+LLM_OUTPUT_TOKENS = int(os.getenv("LLM_OUTPUT_TOKENS", "512"))
+# Rough Gemini tokenisation for English text, used to size prompts without a network call
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "4"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Parse processes per API process; `serve` splits the default across workers
+INGEST_PROCESSES = int(os.getenv("INGEST_PROCESSES", str(max(1, (os.cpu_count() or 2) - 1))))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "100"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+BATCH_UPLOAD_MAX_FILES = int(os.getenv("BATCH_UPLOAD_MAX_FILES", "100"))
+# Concurrent /upload/batch pipelines; further batches get 503
+BATCH_MAX_ACTIVE = int(os.getenv("BATCH_MAX_ACTIVE", "2"))
+# Parsed files (or embedded files) that may wait between pipeline stages
+BATCH_STAGE_QUEUE_SIZE = int(os.getenv("BATCH_STAGE_QUEUE_SIZE", "4"))
+# Chunks from several files are embedded together up to this many per call
+BATCH_EMBED_CHUNKS = int(os.getenv("BATCH_EMBED_CHUNKS", str(EMBED_BATCH_SIZE * 8)))
+# Documents written per bulk insert transaction
+BATCH_INSERT_DOCUMENTS = int(os.getenv("BATCH_INSERT_DOCUMENTS", "16"))
+# Concept maps (BERTopic); UMAP/HDBSCAN need a minimum corpus to be meaningful
+CONCEPT_MAP_MIN_CHUNKS = int(os.getenv("CONCEPT_MAP_MIN_CHUNKS", "30"))
+CONCEPT_MAP_MIN_TOPIC_SIZE = int(os.getenv("CONCEPT_MAP_MIN_TOPIC_SIZE", "5"))
+CONCEPT_MAP_TOP_WORDS = int(os.getenv("CONCEPT_MAP_TOP_WORDS", "8"))
+CONCEPT_MAP_MAX_PASSAGES = int(os.getenv("CONCEPT_MAP_MAX_PASSAGES", "50"))
+# New chunks placed into existing topics before a full refit, as a fraction of the last fit
+CONCEPT_MAP_REFIT_FRACTION = float(os.getenv("CONCEPT_MAP_REFIT_FRACTION", "0.2"))
+CONCEPT_MAP_CACHE_SIZE = int(os.getenv("CONCEPT_MAP_CACHE_SIZE", "16"))
+CONCEPT_MAP_CONCURRENCY = int(os.getenv("CONCEPT_MAP_CONCURRENCY", "1"))
+DOCUMENTS_PAGE_SIZE = int(os.getenv("DOCUMENTS_PAGE_SIZE", "50"))
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32"))
+QUERY_BATCH_MAX_WAIT_MS = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", "5"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+QUERY_LOG_BATCH_SIZE = int(os.getenv("QUERY_LOG_BATCH_SIZE", "50"))
+QUERY_LOG_FLUSH_SECONDS = float(os.getenv("QUERY_LOG_FLUSH_SECONDS", "1"))
+QUERY_LOG_MAX_ROWS = int(os.getenv("QUERY_LOG_MAX_ROWS", "10000"))
+# Consecutive failed flushes (lost connection, timeouts) before a write-behind batch is dropped
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "5"))
+# Model name or a local directory; point at a local copy (and set HF_HUB_OFFLINE=1) for offline boots
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR")
+EMBEDDING_WARMUP = os.getenv("EMBEDDING_WARMUP", "1") == "1"
+# torch | onnx | onnx-int8; the ONNX backends need `optimum[onnxruntime]`
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_INT8_FILE = os.getenv("EMBEDDING_ONNX_INT8_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+EMBEDDING_PARITY_CHECK = os.getenv("EMBEDDING_PARITY_CHECK", "0") == "1"
+EMBEDDING_PARITY_MIN_COSINE = float(os.getenv("EMBEDDING_PARITY_MIN_COSINE", "0.99"))
+# API processes for `python main.py`; above 1 the model is loaded once and workers are forked from it
+WORKERS = int(os.getenv("WORKERS", "1"))
+# torch/BLAS intra-op threads per process; 0 means an even share of the cores per worker
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+# Mirror job status to Postgres and broadcast cache invalidations, needed
+# whenever more than one process serves the API
+SHARED_STATE = os.getenv("SHARED_STATE", "1" if WORKERS > 1 else "0") == "1"
+CACHE_CHANNEL = "inquiro_cache_invalidation"
+JOB_MIRROR_SECONDS = float(os.getenv("JOB_MIRROR_SECONDS", "0.5"))
+NLTK_DATA_DIR = os.getenv("NLTK_DATA_DIR")
+OCR_ENABLED = os.getenv("OCR_ENABLED", "1") == "1"
+# OCR processes per API process; `serve` splits the default across workers
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_DPI = min(int(os.getenv("OCR_DPI", "200")), 300)
+OCR_MAX_PAGE_MB = int(os.getenv("OCR_MAX_PAGE_MB", "64"))
+# vector (float32) or halfvec (float16, pgvector >= 0.7) for document_chunks.embedding
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "vector")
+EMBEDDING_DIM = 384
+VECTOR_CACHE_ENABLED = os.getenv("VECTOR_CACHE_ENABLED", "1") == "1"
+VECTOR_CACHE_MAX_CHUNKS = int(os.getenv("VECTOR_CACHE_MAX_CHUNKS", "5000"))
+VECTOR_CACHE_BUDGET_MB = int(os.getenv("VECTOR_CACHE_BUDGET_MB", "256"))
+# HNSW candidates per scan. The user_id filter applies after the index scan, so
+# on a shared table a small list can come back with fewer than top-k rows; on
+# pgvector >= 0.8 the scan also keeps going (HNSW_ITERATIVE_SCAN) until it fills
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "100"))
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "strict_order")  # off | strict_order | relaxed_order
+# Index chunks for documents stored before per-chunk retrieval, in the background after boot
+CHUNK_BACKFILL_ENABLED = os.getenv("CHUNK_BACKFILL_ENABLED", "1") == "1"
+CHUNK_BACKFILL_BATCH = int(os.getenv("CHUNK_BACKFILL_BATCH", "20"))
 
-print(f"DATABASE_URL from env: {os.getenv('DATABASE_URL')}")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+# Adds a Server-Timing header with per-stage durations to every response
+TIMING_HEADER = os.getenv("TIMING_HEADER", "0") == "1"
+# Fraction of requests profiled with cProfile; dumps go to PROFILE_DIR
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", tempfile.gettempdir())
 
-# Download NLTK resources
-try:
-    nltk.download('punkt_tab', quiet=True)
-    nltk.download('punkt', quiet=True)
-except Exception as e:
-    raise Exception(f"Failed to download NLTK resources: {str(e)}")
+# Logging
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload)
+
+logger = logging.getLogger("inquiro")
+if not logger.handlers:
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(
+        JsonLogFormatter() if LOG_FORMAT == "json"
+        else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    logger.addHandler(log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+logger.debug("DATABASE_URL configured: %s", bool(DATABASE_URL))
+
+# Metrics
+class Metrics:
+    """
+    Minimal Prometheus-style registry: labelled counters and fixed-bucket
+    histograms, rendered in the text exposition format.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self.histograms: Dict[Tuple[str, tuple], list] = {}
+        self.help: Dict[str, Tuple[str, str]] = {}
+
+    def describe(self, name: str, kind: str, text: str) -> None:
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, labels: Optional[dict] = None, value: float = 1.0) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, labels: Optional[dict] = None) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        series = self.histograms.get(key)
+        if series is None:
+            series = self.histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @staticmethod
+    def format_labels(labels) -> str:
+        if not labels:
+            return ""
+        escaped = (f'{k}="{str(v)}"'.replace("\n", " ") for k, v in labels)
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self, gauges: Dict[str, float]) -> str:
+        lines = []
+        described = set()
+
+        def header(name: str, kind: str) -> None:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {self.help.get(name, (kind, name))[1]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), series in sorted(self.histograms.items()):
+            header(name, "histogram")
+            for bound, count in zip(self.BUCKETS, series):
+                lines.append(f"{name}_bucket{self.format_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{self.format_labels(labels + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {series[-2]}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {series[-1]}")
+        for name, value in sorted(gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("inquiro_stage_seconds", "histogram", "Time spent per pipeline stage")
+metrics.describe("inquiro_sql_seconds", "histogram", "SQL statement latency by statement")
+metrics.describe("inquiro_http_request_seconds", "histogram", "HTTP request latency by route")
+metrics.describe("inquiro_db_pool_saturated_total", "counter", "Acquires that found no idle connection at max pool size")
+metrics.describe("inquiro_db_pool_timeouts_total", "counter", "Statements cancelled by the command or statement timeout")
+metrics.describe("inquiro_cache_requests_total", "counter", "Cache lookups by cache and result")
+metrics.describe("inquiro_llm_rejected_total", "counter", "LLM calls refused by the gateway")
+metrics.describe("inquiro_bcrypt_rejected_total", "counter", "Password hash/verify calls refused at the admission limit")
+
+# Stage durations for the current request, when a timing header or profile is wanted
+request_timings: ContextVar[Optional[dict]] = ContextVar("request_timings", default=None)
+
+def record_stage(stage: str, seconds: float) -> None:
+    metrics.observe("inquiro_stage_seconds", seconds, {"stage": stage})
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def timed(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+SQL_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN|TABLE)\s+([A-Za-z_][A-Za-z0-9_.]*)", re.IGNORECASE)
+sql_labels: Dict[str, str] = {}
+
+def sql_label(query: str) -> str:
+    """
+    Low-cardinality statement label such as "SELECT document_chunks".
+    """
+    label = sql_labels.get(query)
+    if label is None:
+        verb = query.split(None, 1)[0].upper() if query.strip() else "UNKNOWN"
+        table = SQL_TABLE.search(query)
+        label = f"{verb} {table.group(1)}" if table else verb
+        sql_labels[query] = label
+    return label
+
+def record_query(record) -> None:
+    metrics.observe("inquiro_sql_seconds", record.elapsed, {"statement": sql_label(record.query)})
+
+profiling_active = False
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    """
+    Per-route latency histogram, plus an optional Server-Timing header and
+    sampled cProfile dumps. The profiler is process-wide, so at most one
+    request is profiled at a time and its dump includes concurrent work.
+    """
+    global profiling_active
+    timings = {}
+    token = request_timings.set(timings)
+    profiler = None
+    if PROFILE_SAMPLE_RATE > 0 and not profiling_active and random.random() < PROFILE_SAMPLE_RATE:
+        profiling_active = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        elapsed = time.perf_counter() - started
+        request_timings.reset(token)
+        if profiler:
+            profiler.disable()
+            profiling_active = False
+            dump = os.path.join(PROFILE_DIR, f"profile-{int(time.time() * 1000)}-{request.url.path.strip('/').replace('/', '_') or 'root'}.prof")
+            profiler.dump_stats(dump)
+            logger.info("Profiled %s %s in %.1f ms: %s", request.method, request.url.path, elapsed * 1000, dump)
+
+    route = request.scope.get("route")
+    metrics.observe(
+        "inquiro_http_request_seconds", elapsed,
+        {"method": request.method, "route": route.path if route else "unmatched", "status": response.status_code}
+    )
+    if TIMING_HEADER:
+        timings["total"] = elapsed
+        response.headers["Server-Timing"] = ", ".join(
+            f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+        )
+    return response
+
+
+# NLTK resources are read from disk only; fetch them ahead of time with `python main.py prefetch`.
+# Without punkt, sentence splitting falls back to splitting on periods.
+if NLTK_DATA_DIR:
+    nltk.data.path.insert(0, NLTK_DATA_DIR)
+
+def check_sentence_tokenizer() -> bool:
+    """
+    Warn when punkt is missing, since chunking would otherwise degrade silently.
+    """
+    for resource in ("tokenizers/punkt_tab", "tokenizers/punkt"):
+        try:
+            nltk.data.find(resource)
+            return True
+        except LookupError:
+            continue
+    logger.warning(
+        "NLTK punkt not found on %s; sentences will be split on periods. Run `python main.py prefetch`",
+        nltk.data.path
+    )
+    return False
 
 # Initialize Gemini API
 try:
@@ -67,18 +420,319 @@ try:
 except Exception as e:
     raise Exception(f"Failed to configure Gemini API: {str(e)}")
 
-# Initialize SentenceTransformer
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+# SentenceTransformer is loaded in `lifespan`, keeping torch out of the import path
+embedder = None
+embedder_ready = asyncio.Event()
+
+EMBEDDING_BACKENDS = {
+    "torch": {"backend": "torch"},
+    "onnx": {"backend": "onnx"},
+    "onnx-int8": {"backend": "onnx", "model_kwargs": {"file_name": EMBEDDING_ONNX_INT8_FILE}},
+}
+
+# Fixed sample used to compare a backend against the PyTorch reference
+PARITY_SENTENCES = [
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "The derivative of a function measures its instantaneous rate of change.",
+    "Mitochondria are the site of cellular respiration in eukaryotic cells.",
+    "A binary search tree keeps keys ordered so lookups take logarithmic time.",
+    "The French Revolution began in 1789 and reshaped European politics.",
+    "Supply and demand determine the equilibrium price in a competitive market.",
+    "Newton's second law states that force equals mass times acceleration.",
+    "Enzymes lower the activation energy required for biochemical reactions.",
+]
+
+def create_embedder(backend: str = EMBEDDING_BACKEND):
+    """
+    Build the embedding engine for `backend`. All backends are SentenceTransformer
+    instances, so callers keep using `encode(...)` unchanged.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in EMBEDDING_BACKENDS:
+        raise Exception(f"Unknown EMBEDDING_BACKEND {backend!r}; expected one of {', '.join(EMBEDDING_BACKENDS)}")
+    try:
+        return SentenceTransformer(EMBEDDING_MODEL, cache_folder=MODEL_CACHE_DIR, **EMBEDDING_BACKENDS[backend])
+    except ImportError as e:
+        raise Exception(f"Embedding backend {backend} requires optimum[onnxruntime]: {str(e)}")
+
+def embedding_parity(model, backend: str = EMBEDDING_BACKEND) -> dict:
+    """
+    Cosine agreement and encode throughput of `model` against the PyTorch reference.
+    """
+    reference = model if backend == "torch" else create_embedder("torch")
+    sentences = PARITY_SENTENCES * 8
+
+    def timed_encode(engine):
+        engine.encode(sentences[:2], normalize_embeddings=True)
+        started = time.perf_counter()
+        vectors = engine.encode(sentences, batch_size=EMBED_BATCH_SIZE, normalize_embeddings=True)
+        return vectors, len(sentences) / (time.perf_counter() - started)
+
+    expected, reference_rate = timed_encode(reference)
+    actual, rate = timed_encode(model)
+    cosines = np.sum(expected * actual, axis=1)
+    return {
+        "backend": backend,
+        "mean_cosine": round(float(cosines.mean()), 5),
+        "min_cosine": round(float(cosines.min()), 5),
+        "sentences_per_second": round(rate, 1),
+        "reference_sentences_per_second": round(reference_rate, 1),
+        "speedup": round(rate / reference_rate, 2),
+    }
+
+def warm_up_embedder(model) -> None:
+    started = time.perf_counter()
+    model.encode(["warm-up"], normalize_embeddings=True)
+    logger.info("Embedding warm-up took %.2fs", time.perf_counter() - started)
+
+def load_embedder(check: bool = True):
+    """
+    Load the embedding model. With `check=False` no inference runs, which the
+    pre-fork parent needs: OpenMP thread pools do not survive fork().
+    """
+    started = time.perf_counter()
+    model = create_embedder(EMBEDDING_BACKEND)
+    logger.info("Embedding model %s (%s) loaded in %.2fs", EMBEDDING_MODEL, EMBEDDING_BACKEND, time.perf_counter() - started)
+    if check and EMBEDDING_PARITY_CHECK and EMBEDDING_BACKEND != "torch":
+        report = embedding_parity(model)
+        logger.info("Embedding parity: %s", report)
+        if report["min_cosine"] < EMBEDDING_PARITY_MIN_COSINE:
+            logger.warning("%s drifts from the reference model (min cosine %s)", EMBEDDING_BACKEND, report["min_cosine"])
+    if check and EMBEDDING_WARMUP:
+        warm_up_embedder(model)
+    return model
+
+def limit_threads(threads: int) -> None:
+    """
+    Cap torch and BLAS intra-op threads for this process (and its children).
+    """
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(threads)
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+
+async def load_embedder_async() -> None:
+    global embedder
+    try:
+        if embedder is None:
+            if EMBEDDING_THREADS:
+                limit_threads(EMBEDDING_THREADS)
+            embedder = await asyncio.to_thread(load_embedder)
+        elif EMBEDDING_WARMUP:
+            # Loaded by the pre-fork parent; each worker warms up its own thread pool
+            await asyncio.to_thread(warm_up_embedder, embedder)
+    except Exception as e:
+        logger.exception("Failed to load embedding model: %s", e)
+        raise
+    embedder_ready.set()
+
+def prefetch_assets() -> None:
+    """
+    Download NLTK data and the embedding model so later boots need no network.
+    """
+    for resource in ("punkt_tab", "punkt"):
+        if not nltk.download(resource, download_dir=NLTK_DATA_DIR, quiet=True):
+            raise Exception(f"Failed to download NLTK resource {resource}")
+    create_embedder(EMBEDDING_BACKEND)
+    logger.info("Prefetched NLTK data and %s (%s)", EMBEDDING_MODEL, EMBEDDING_BACKEND)
+
+def export_onnx_int8(output_dir: str, quantization: str = "avx512_vnni") -> None:
+    """
+    Export the model to ONNX and write a dynamically quantised int8 variant to
+    <output_dir>/onnx/model_qint8_<quantization>.onnx; point EMBEDDING_MODEL at output_dir.
+    """
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    model = create_embedder("onnx")
+    model.save_pretrained(output_dir)
+    export_dynamic_quantized_onnx_model(model, quantization, output_dir)
+    logger.info("Exported int8 ONNX model to %s/onnx/model_qint8_%s.onnx", output_dir, quantization)
 
 # OAuth2 scheme for JWT
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Tables added on top of the base schema; safe to run on every boot
+SCHEMA_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS document_chunks (
+        chunk_id UUID PRIMARY KEY,
+        document_id UUID NOT NULL REFERENCES document(id) ON DELETE CASCADE,
+        user_id UUID NOT NULL,
+        chunk_index INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        embedding {EMBEDDING_STORAGE}({EMBEDDING_DIM}) NOT NULL
+    )
+    """.format(EMBEDDING_STORAGE=EMBEDDING_STORAGE, EMBEDDING_DIM=EMBEDDING_DIM),
+    "CREATE INDEX IF NOT EXISTS document_chunks_user_idx ON document_chunks(user_id)",
+    "CREATE INDEX IF NOT EXISTS document_chunks_document_idx ON document_chunks(document_id, chunk_index)",
+    f"CREATE INDEX IF NOT EXISTS document_chunks_embedding_idx ON document_chunks USING hnsw (embedding {EMBEDDING_STORAGE}_cosine_ops)",
+    # Stats recorded at upload so /documents never has to read content
+    "ALTER TABLE document ADD COLUMN IF NOT EXISTS page_count INTEGER",
+    "ALTER TABLE document ADD COLUMN IF NOT EXISTS chunk_count INTEGER",
+    "ALTER TABLE document ADD COLUMN IF NOT EXISTS char_count INTEGER",
+    # Older rows only get the estimates the listing used to compute on the fly
+    """
+    UPDATE document
+    SET char_count = char_length(content),
+        page_count = GREATEST(1, char_length(content) / 2000),
+        chunk_count = GREATEST(1, char_length(content) / 500)
+    WHERE char_count IS NULL
+    """,
+    "CREATE INDEX IF NOT EXISTS document_user_created_idx ON document(user_id, created_at DESC, id DESC)",
+    # Fingerprints for identical-file reuse and page-level change detection
+    "ALTER TABLE document ADD COLUMN IF NOT EXISTS content_hash TEXT",
+    "ALTER TABLE document ADD COLUMN IF NOT EXISTS page_hashes TEXT[]",
+    "CREATE INDEX IF NOT EXISTS document_content_hash_idx ON document(content_hash)",
+    # Job status shared between API workers (SHARED_STATE)
+    """
+    CREATE TABLE IF NOT EXISTS ingestion_job (
+        job_id UUID PRIMARY KEY,
+        user_id UUID NOT NULL,
+        state JSONB NOT NULL,
+        updated_at TIMESTAMP NOT NULL
+    )
+    """,
+]
+
+# pgvector binary wire format: uint16 dimension, uint16 unused, then big-endian
+# float32 (vector) or float16 (halfvec) components
+def encode_vector(value) -> bytes:
+    array = np.asarray(value, dtype=">f4")
+    return struct.pack(">HH", array.shape[0], 0) + array.tobytes()
+
+def decode_vector(data: bytes) -> np.ndarray:
+    dim = struct.unpack_from(">H", data)[0]
+    return np.frombuffer(data, dtype=">f4", count=dim, offset=4).astype(np.float32)
+
+def encode_halfvec(value) -> bytes:
+    array = np.asarray(value, dtype=">f2")
+    return struct.pack(">HH", array.shape[0], 0) + array.tobytes()
+
+def decode_halfvec(data: bytes) -> np.ndarray:
+    dim = struct.unpack_from(">H", data)[0]
+    return np.frombuffer(data, dtype=">f2", count=dim, offset=4).astype(np.float32)
+
+async def register_vector_codecs(conn: asyncpg.Connection) -> None:
+    """
+    Send and receive pgvector values as NumPy arrays in binary format instead of text literals.
+    """
+    types = await conn.fetch(
+        "SELECT typname, typnamespace::regnamespace::text AS schema FROM pg_type WHERE typname IN ('vector', 'halfvec')"
+    )
+    codecs = {"vector": (encode_vector, decode_vector), "halfvec": (encode_halfvec, decode_halfvec)}
+    for row in types:
+        encoder, decoder = codecs[row['typname']]
+        await conn.set_type_codec(
+            row['typname'], schema=row['schema'], encoder=encoder, decoder=decoder, format="binary"
+        )
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    await register_vector_codecs(conn)
+    conn.add_query_logger(record_query)
+
+# Callers currently blocked in pool.acquire()
+db_waiting = 0
+
+@asynccontextmanager
+async def db_connection():
+    """
+    pool.acquire() that records how long the caller waited for a connection.
+    """
+    global db_waiting
+    if pool.get_idle_size() == 0 and pool.get_size() >= pool.get_max_size():
+        metrics.inc("inquiro_db_pool_saturated_total")
+    started = time.perf_counter()
+    db_waiting += 1
+    try:
+        conn = await pool.acquire()
+    finally:
+        db_waiting -= 1
+    record_stage("db_acquire", time.perf_counter() - started)
+    try:
+        yield conn
+    except (asyncio.TimeoutError, asyncpg.QueryCanceledError):
+        metrics.inc("inquiro_db_pool_timeouts_total")
+        raise
+    finally:
+        await pool.release(conn)
+
+async def migrate_embedding_storage(conn: asyncpg.Connection) -> None:
+    """
+    Convert document_chunks.embedding to EMBEDDING_STORAGE in place, rebuilding its index.
+    """
+    current = await conn.fetchval(
+        "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+        "WHERE attrelid = 'document_chunks'::regclass AND attname = 'embedding'"
+    )
+    target = f"{EMBEDDING_STORAGE}({EMBEDDING_DIM})"
+    if current == target:
+        return
+    logger.info("Migrating document_chunks.embedding from %s to %s", current, target)
+    async with conn.transaction():
+        await conn.execute("DROP INDEX IF EXISTS document_chunks_embedding_idx")
+        await conn.execute(f"ALTER TABLE document_chunks ALTER COLUMN embedding TYPE {target} USING embedding::{target}")
+        await conn.execute(
+            f"CREATE INDEX document_chunks_embedding_idx ON document_chunks USING hnsw (embedding {EMBEDDING_STORAGE}_cosine_ops)"
+        )
+
+def vector_search_settings(pgvector_version: Optional[str]) -> Dict[str, str]:
+    """
+    Session defaults for HNSW scans. They go in as startup parameters rather
+    than SET, since the pool's RESET ALL on release would undo a SET.
+    """
+    settings = {"hnsw.ef_search": str(HNSW_EF_SEARCH)}
+    version = tuple(int(part) for part in re.findall(r"\d+", pgvector_version or "")[:2])
+    if HNSW_ITERATIVE_SCAN != "off" and version >= (0, 8):
+        settings["hnsw.iterative_scan"] = HNSW_ITERATIVE_SCAN
+    return settings
+
+# Set by prepare_database. The pre-fork parent runs it once before forking, so
+# workers do not race each other through the DDL, backfills and migrations.
+schema_prepared = False
+pgvector_version: Optional[str] = None
+
+async def prepare_database() -> None:
+    """
+    Create and migrate the schema on a dedicated connection and record the
+    installed pgvector version.
+    """
+    global schema_prepared, pgvector_version
+    if not DATABASE_URL:
+        raise Exception("DATABASE_URL not found in environment variables")
+    if EMBEDDING_STORAGE not in ("vector", "halfvec"):
+        raise Exception(f"Unknown EMBEDDING_STORAGE {EMBEDDING_STORAGE!r}; expected vector or halfvec")
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        for statement in SCHEMA_STATEMENTS:
+            await conn.execute(statement)
+        await migrate_embedding_storage(conn)
+        pgvector_version = await conn.fetchval("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        schema_prepared = True
+    finally:
+        await conn.close()
+
 # Database connection pool
 async def init_db() -> asyncpg.Pool:
     try:
-        if not DATABASE_URL:
-            raise Exception("DATABASE_URL not found in environment variables")
-        pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+        if not schema_prepared:
+            await prepare_database()
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=DB_POOL_MAX_IDLE_SECONDS,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            server_settings={
+                "statement_timeout": str(DB_STATEMENT_TIMEOUT_MS),
+                **vector_search_settings(pgvector_version),
+            },
+            init=init_connection,
+        )
         return pool
     except Exception as e:
         raise Exception(f"Failed to connect to database: {str(e)}")
@@ -125,7 +779,59 @@ def create_access_token(data: dict) -> str:
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
+class TokenCache:
+    """
+    Verified JWTs keyed by their SHA-256 digest, so repeat requests skip the
+    signature check. Entries live for `ttl_seconds` or until the token expires,
+    whichever comes first.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.entries: "OrderedDict[bytes, Tuple[str, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str) -> Optional[str]:
+        if self.max_entries <= 0:
+            return None
+        key = self.key(token)
+        entry = self.entries.get(key)
+        if entry and entry[1] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            metrics.inc("inquiro_cache_requests_total", {"cache": "token", "result": "hit"})
+            return entry[0]
+        if entry:
+            del self.entries[key]
+        self.misses += 1
+        metrics.inc("inquiro_cache_requests_total", {"cache": "token", "result": "miss"})
+        return None
+
+    def store(self, token: str, user_id: str, expires_at: Optional[float]) -> None:
+        if self.max_entries <= 0:
+            return
+        ttl = self.ttl if expires_at is None else min(self.ttl, expires_at - time.time())
+        if ttl <= 0:
+            return
+        self.entries[self.key(token)] = (user_id, time.monotonic() + ttl)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_SECONDS)
+
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> str:
+    user_id = token_cache.get(token)
+    if user_id:
+        return user_id
     try:
         if not JWT_SECRET:
             raise HTTPException(status_code=500, detail="JWT_SECRET not configured")
@@ -133,346 +839,2140 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> str:
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+        token_cache.store(token, user_id, payload.get("exp"))
         return user_id
     except jwt.PyJWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
-def extract_text_chunks(reader: PyPDF2.PdfReader, max_chunk_size: int = 500) -> List[str]:
+# bcrypt is deliberately slow (~200 ms at cost 12); run it off the event loop
+bcrypt_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+bcrypt_pending = 0
+
+async def run_bcrypt(func, *args):
     """
-    Extract text from PDF in chunks with better error handling and debugging.
+    Run a bcrypt call on the bounded executor, refusing new work with 503
+    once BCRYPT_MAX_PENDING calls are already queued or running.
     """
-    chunks = []
-    total_text = ""
-    
+    global bcrypt_pending
+    if bcrypt_pending >= BCRYPT_MAX_PENDING:
+        metrics.inc("inquiro_bcrypt_rejected_total")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many sign-in requests, please retry shortly",
+            headers={"Retry-After": "1"}
+        )
+    bcrypt_pending += 1
     try:
-        # Debug: Check if PDF is encrypted
-        if reader.is_encrypted:
-            raise Exception("PDF is password-protected. Please provide an unencrypted version.")
-        
-        # Extract text from all pages
-        for page_num, page in enumerate(reader.pages):
-            try:
-                text = page.extract_text()
-                if text and text.strip():
-                    total_text += text + "\n"
-                    print(f"Page {page_num + 1}: Extracted {len(text)} characters")
-                else:
-                    print(f"Page {page_num + 1}: No text found (possibly scanned/image-based)")
-            except Exception as page_error:
-                print(f"Error extracting from page {page_num + 1}: {str(page_error)}")
-                continue
-        
-        # Debug: Print total extracted text length
-        print(f"Total text extracted: {len(total_text)} characters")
-        
-        if not total_text.strip():
-            raise Exception("No text content found. This might be a scanned PDF or image-based PDF that requires OCR.")
-        
-        # Process the extracted text into chunks
-        # Split by double newlines (paragraphs) first
-        paragraphs = total_text.split("\n\n")
-        
-        for para in paragraphs:
-            para = para.strip()
-            if len(para) < 10:  # Skip very short paragraphs
-                continue
-                
-            # Clean up the paragraph
-            para = " ".join(para.split())  # Normalize whitespace
-            
-            # If paragraph is short enough, add as single chunk
-            if len(para) <= max_chunk_size:
-                chunks.append(para)
-            else:
-                # Split long paragraphs into sentences
-                try:
-                    sentences = nltk.sent_tokenize(para)
-                    current_chunk = ""
-                    
-                    for sentence in sentences:
-                        if len(current_chunk) + len(sentence) + 1 <= max_chunk_size:
-                            current_chunk += sentence + " "
-                        else:
-                            if current_chunk.strip():
-                                chunks.append(current_chunk.strip())
-                            current_chunk = sentence + " "
-                    
-                    if current_chunk.strip():
-                        chunks.append(current_chunk.strip())
-                        
-                except Exception as nltk_error:
-                    # Fallback: split by periods if NLTK fails
-                    sentences = para.split('. ')
-                    current_chunk = ""
-                    
-                    for sentence in sentences:
-                        if not sentence.endswith('.'):
-                            sentence += '.'
-                        if len(current_chunk) + len(sentence) + 1 <= max_chunk_size:
-                            current_chunk += sentence + " "
-                        else:
-                            if current_chunk.strip():
-                                chunks.append(current_chunk.strip())
-                            current_chunk = sentence + " "
-                    
-                    if current_chunk.strip():
-                        chunks.append(current_chunk.strip())
-    
-    except Exception as e:
-        print(f"Error in extract_text_chunks: {str(e)}")
-        raise
-    
-    # Filter out chunks that are too short or contain mostly non-alphabetic characters
-    filtered_chunks = []
-    for chunk in chunks:
-        # Check if chunk has sufficient alphabetic content
-        alpha_chars = sum(1 for c in chunk if c.isalpha())
-        if len(chunk) >= 20 and alpha_chars / len(chunk) > 0.5:
-            filtered_chunks.append(chunk)
-    
-    print(f"Final chunks: {len(filtered_chunks)} chunks created")
-    return filtered_chunks
+        with timed("bcrypt"):
+            return await asyncio.get_running_loop().run_in_executor(bcrypt_executor, func, *args)
+    finally:
+        bcrypt_pending -= 1
 
+async def hash_password(password: str) -> str:
+    hashed = await run_bcrypt(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    return hashed.decode('utf-8')
 
-# User APIs
-@app.post("/register")
-async def register_user(user: UserCreate):
-    if not pool:
-        raise HTTPException(status_code=500, detail="Database connection not initialized")
-    
+async def verify_password(password: str, password_hash: str) -> bool:
+    return await run_bcrypt(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+def iter_page_texts(reader: PyPDF2.PdfReader, page_state: Optional[dict] = None) -> Iterator[Optional[str]]:
+    """
+    Yield each page's extracted text, or None where extraction failed.
+
+    `page_state`, when given, is filled with a SHA-256 per page ("hashes") and
+    the textless pages worth OCR as (page_number, dpi) pairs ("textless").
+    """
+    if reader.is_encrypted:
+        raise Exception("PDF is password-protected. Please provide an unencrypted version.")
+
+    for page_num, page in enumerate(reader.pages):
+        try:
+            text = page.extract_text()
+        except Exception as page_error:
+            logger.warning("Error extracting from page %d: %s", page_num + 1, page_error)
+            text = None
+        if page_state is not None:
+            page_state["hashes"].append(hashlib.sha256((text or "").encode("utf-8")).hexdigest())
+            if not text or not text.strip():
+                page_state["textless"].append((page_num + 1, ocr_dpi(page)))
+        yield text
+
+def iter_paragraphs(page_texts: Iterable[Optional[str]]) -> Iterator[str]:
+    """
+    Yield "\n\n"-separated paragraphs page by page. Only the unfinished tail of
+    the previous page is carried over, so working memory stays at about one page.
+    """
+    pending = ""
+    total_length = 0
+    for page_num, text in enumerate(page_texts):
+        if not text or not text.strip():
+            if text is not None:
+                logger.debug("Page %d: No text found (possibly scanned/image-based)", page_num + 1)
+            continue
+        logger.debug("Page %d: Extracted %d characters", page_num + 1, len(text))
+        total_length += len(text) + 1
+
+        paragraphs = (pending + text + "\n").split("\n\n")
+        pending = paragraphs.pop()
+        yield from paragraphs
+
+    # Debug: Print total extracted text length
+    logger.debug("Total text extracted: %d characters", total_length)
+
+    if not total_length:
+        raise Exception("No text content found. This might be a scanned PDF or image-based PDF that requires OCR.")
+    yield pending
+
+def ocr_dpi(page) -> int:
+    """
+    Rasterisation DPI for OCR: OCR_DPI, lowered for large pages so one page image
+    stays under OCR_MAX_PAGE_MB (RGB) in the worker.
+    """
     try:
-        password_hash = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-        async with pool.acquire() as conn:
-            try:
-                user_id = uuid.uuid4()
-                await conn.execute(
-                    "INSERT INTO users(user_id, username, email, password_hash, created_at) VALUES ($1, $2, $3, $4, $5)",
-                    user_id, user.username, user.email, password_hash, datetime.utcnow()
-                )
-                return {"message": "User registered successfully", "user_id": str(user_id)}
-            except asyncpg.UniqueViolationError:
-                raise HTTPException(status_code=400, detail="Username or email already exists")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to register user: {str(e)}")
+        area_sq_inches = float(page.mediabox.width) * float(page.mediabox.height) / (72 * 72)
+    except Exception:
+        return OCR_DPI
+    max_pixels = OCR_MAX_PAGE_MB * 1024 * 1024 / 3
+    if area_sq_inches <= 0:
+        return OCR_DPI
+    return max(72, min(OCR_DPI, int((max_pixels / area_sq_inches) ** 0.5)))
 
-@app.post("/login")
-async def login_user(form_data: OAuth2PasswordRequestForm = Depends()):
-    if not pool:
-        raise HTTPException(status_code=500, detail="Database connection not initialized")
-    
+def ocr_page(path: str, page_number: int, dpi: int) -> Tuple[int, str, float]:
+    """
+    Rasterise one page and run Tesseract on it. Runs inside the OCR process pool.
+    """
+    from pdf2image import convert_from_path
+    import pytesseract
+
+    started = time.perf_counter()
+    images = convert_from_path(path, dpi=dpi, first_page=page_number, last_page=page_number)
+    text = "\n".join(pytesseract.image_to_string(image) for image in images)
+    return page_number, text, time.perf_counter() - started
+
+def init_ocr_worker() -> None:
+    # One Tesseract thread per worker; the pool itself provides the parallelism
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+def split_paragraph(para: str, max_chunk_size: int) -> Iterator[str]:
+    """
+    Split one normalised paragraph into chunks of at most max_chunk_size characters.
+    """
+    # If paragraph is short enough, add as single chunk
+    if len(para) <= max_chunk_size:
+        yield para
+        return
+
+    # Split long paragraphs into sentences
     try:
-        async with pool.acquire() as conn:
-            user = await conn.fetchrow(
-                "SELECT user_id, password_hash FROM users WHERE username = $1", form_data.username
-            )
-            if not user or not bcrypt.checkpw(form_data.password.encode('utf-8'), user['password_hash'].encode('utf-8')):
-                raise HTTPException(status_code=401, detail="Invalid username or password")
-            access_token = create_access_token(data={"sub": str(user['user_id'])})
-            return {"access_token": access_token, "token_type": "bearer"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to login: {str(e)}")
+        sentences = nltk.sent_tokenize(para)
+    except Exception:
+        # Fallback: split by periods if NLTK fails
+        sentences = [s if s.endswith('.') else s + '.' for s in para.split('. ')]
 
-# Document APIs
-# Updated upload endpoint with better error messages
+    current_chunk = ""
+    for sentence in sentences:
+        if len(current_chunk) + len(sentence) + 1 <= max_chunk_size:
+            current_chunk += sentence + " "
+        else:
+            if current_chunk.strip():
+                yield current_chunk.strip()
+            current_chunk = sentence + " "
 
-@app.post("/upload")
-async def upload_document(file: UploadFile = File(...), user_id: str = Depends(get_current_user)):
-    if not pool:
-        raise HTTPException(status_code=500, detail="Database connection not initialized")
-    
-    # Check if filename exists and is a PDF
-    if not file.filename or not file.filename.endswith('.pdf'):
-        raise HTTPException(status_code=400, detail="Only PDF files can be uploaded")
-    
+    if current_chunk.strip():
+        yield current_chunk.strip()
+
+def iter_text_chunks(page_texts: Iterable[Optional[str]], max_chunk_size: int = 500) -> Iterator[str]:
+    """
+    Stream text chunks out of a PDF page by page.
+    """
+    for para in iter_paragraphs(page_texts):
+        para = para.strip()
+        if len(para) < 10:  # Skip very short paragraphs
+            continue
+
+        # Clean up the paragraph
+        para = " ".join(para.split())  # Normalize whitespace
+
+        # Keep chunks with sufficient alphabetic content
+        for chunk in split_paragraph(para, max_chunk_size):
+            if len(chunk) >= 20 and sum(map(str.isalpha, chunk)) / len(chunk) > 0.5:
+                yield chunk
+
+def extract_text_chunks(page_texts: Iterable[Optional[str]], max_chunk_size: int = 500) -> List[str]:
+    """
+    Extract text from PDF in chunks with better error handling and debugging.
+    """
     try:
-        async with pool.acquire() as conn:
-            existing_document = await conn.fetchrow(
-                "SELECT id FROM document WHERE user_id = $1 AND title = $2",
-                uuid.UUID(user_id), file.filename
-            )
-            if existing_document:
-                raise HTTPException(status_code=400, detail="A file with this name already exists")
+        chunks = list(iter_text_chunks(page_texts, max_chunk_size))
+    except Exception as e:
+        logger.exception("Error in extract_text_chunks: %s", e)
+        raise
 
-            # Reset file pointer to beginning
-            await file.seek(0)
+    logger.debug("Final chunks: %d chunks created", len(chunks))
+    return chunks
 
-            # Create PDF reader
-            try:
-                reader = PyPDF2.PdfReader(file.file)
-                print(f"PDF loaded successfully. Pages: {len(reader.pages)}")
-            except Exception as pdf_error:
-                print(f"PDF reading error: {str(pdf_error)}")
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Failed to read PDF file. The file may be corrupted. Error: {str(pdf_error)}"
-                )
+def embed_chunks(chunks: List[str]) -> np.ndarray:
+    """
+    Encode chunks in batches. Rows are L2-normalised so cosine distance is a dot product.
+    """
+    return embedder.encode(chunks, batch_size=EMBED_BATCH_SIZE, normalize_embeddings=True)
 
-            # Extract text chunks
-            try:
-                chunks = extract_text_chunks(reader)
-            except Exception as chunk_error:
-                print(f"Text extraction error: {str(chunk_error)}")
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Failed to extract text: {str(chunk_error)}"
-                )
+class EmbeddingBatcher:
+    """
+    Collects concurrent encode requests for up to max_wait_ms (or max_size items)
+    and runs them as one batched forward pass on a worker thread.
+    """
 
-            if not chunks:
-                raise HTTPException(
-                    status_code=400, 
-                    detail="No readable text content found in the PDF. This might be a scanned document or image-based PDF."
-                )
+    def __init__(self, max_size: int, max_wait_ms: float):
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stats = {"batches": 0, "items": 0, "last_batch_size": 0, "last_batch_ms": 0.0, "max_batch_size": 0}
 
-            content = "\n".join(chunks)
-            
-            if len(content.strip()) < 100:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Insufficient content extracted ({len(content)} characters). Please ensure the PDF contains substantial readable text."
-                )
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
 
-            print(f"Successfully extracted {len(content)} characters from PDF")
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
 
-            # Generate embedding
-            try:
-                embedding = embedder.encode(content).tolist()
-                embedding_str = str(embedding)
-            except Exception as embed_error:
-                print(f"Embedding generation error: {str(embed_error)}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to generate embedding: {str(embed_error)}"
-                )
+    async def encode(self, text: str) -> np.ndarray:
+        if not self.task:
+            await embedder_ready.wait()
+            return await asyncio.to_thread(embedder.encode, text, normalize_embeddings=True)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            await embedder_ready.wait()
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
 
-            # Save to database
+            texts = [text for text, _ in batch]
+            started = time.perf_counter()
             try:
-                doc_id = uuid.uuid4()
-                await conn.execute(
-                    "INSERT INTO document(id, user_id, title, content, embedding, created_at) "
-                    "VALUES ($1, $2, $3, $4, $5, $6)",
-                    doc_id, uuid.UUID(user_id), file.filename, content, 
-                    embedding_str, datetime.utcnow()
-                )
-            except Exception as db_error:
-                print(f"Database insertion error: {str(db_error)}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to save document to database: {str(db_error)}"
+                vectors = await asyncio.to_thread(
+                    embedder.encode, texts, batch_size=len(texts), normalize_embeddings=True
                 )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            record_stage("query_embedding_batch", elapsed_ms / 1000)
 
-            return {
-                "id": str(doc_id),
-                "message": f"Document uploaded successfully! Processed {len(chunks)} text chunks from {len(reader.pages)} pages.",
-                "stats": {
-                    "pages": len(reader.pages),
-                    "chunks": len(chunks),
-                    "total_characters": len(content)
-                }
-            }
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
 
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        print(f"Unexpected error during upload: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Unexpected error during upload: {str(e)}")
+            self.stats["batches"] += 1
+            self.stats["items"] += len(batch)
+            self.stats["last_batch_size"] = len(batch)
+            self.stats["last_batch_ms"] = round(elapsed_ms, 2)
+            self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+            logger.debug("Query embedding batch: %d items in %.1f ms", len(batch), elapsed_ms)
 
-@app.post("/query")
-async def query_document(query: QueryRequest, user_id: str = Depends(get_current_user)):
-    if not pool:
-        raise HTTPException(status_code=500, detail="Database connection not initialized")
-    
-    try:
-        query_embedding = embedder.encode(query.question).tolist()
-        query_embedding_str = str(query_embedding)
+query_batcher = EmbeddingBatcher(QUERY_BATCH_MAX_SIZE, QUERY_BATCH_MAX_WAIT_MS)
+
+def document_embedding(chunk_embeddings: np.ndarray) -> np.ndarray:
+    """
+    Document-level vector as the normalised mean of its chunk vectors.
+    """
+    mean = chunk_embeddings.mean(axis=0)
+    norm = np.linalg.norm(mean)
+    return mean / norm if norm > 0 else mean
+
+# Hot statements kept as constants so every call sends identical text and reuses the
+# connection's cached prepared statement
+CHUNK_SEARCH_SQL = (
+    "SELECT c.chunk_id, c.document_id AS id, d.title, c.content, c.chunk_index "
+    "FROM document_chunks c JOIN document d ON d.id = c.document_id "
+    f"WHERE c.user_id = $1 ORDER BY c.embedding <=> $2::{EMBEDDING_STORAGE} LIMIT $3"
+)
+DOCUMENT_SEARCH_SQL = (
+    "SELECT id AS chunk_id, id, title, content, 0 AS chunk_index FROM document "
+    "WHERE user_id = $1 ORDER BY embedding <=> $2::vector LIMIT 3"
+)
+DOCUMENT_LOOKUP_SQL = "SELECT content, title FROM document WHERE id = $1 AND user_id = $2"
+DOCUMENT_CHUNKS_SQL = "SELECT content, chunk_index FROM document_chunks WHERE document_id = $1 ORDER BY chunk_index"
+FLASHCARDS_SQL = (
+    "SELECT flashcard_id, question, answer, created_at FROM flashcards "
+    "WHERE document_id = $1 AND user_id = $2 ORDER BY created_at"
+)
+
+async def retrieve_chunks(conn: asyncpg.Connection, user_id: str, query_vector: np.ndarray, top_k: int = QUERY_TOP_K_CHUNKS):
+    """
+    Top-k passages across all of a user's documents, falling back to whole
+    documents for rows uploaded before chunks were indexed.
+    """
+    rows = await conn.fetch(CHUNK_SEARCH_SQL, uuid.UUID(user_id), query_vector, top_k)
+    if rows:
+        return rows
+    # A whole document rarely fits the context budget, so split it back into
+    # the newline-separated chunks it was stored as, in reading order
+    documents = await conn.fetch(DOCUMENT_SEARCH_SQL, uuid.UUID(user_id), query_vector)
+    return [
+        {"chunk_id": (row['id'], index), "id": row['id'], "title": row['title'], "content": text, "chunk_index": index}
+        for row in documents
+        for index, text in enumerate((row['content'] or "").split("\n")) if text.strip()
+    ]
+
+class VectorIndexCache:
+    """
+    In-process chunk index per active user: a contiguous float32 matrix of
+    normalised embeddings searched with one matrix-vector product. Users with
+    more than `max_chunks` chunks stay on Postgres. Entries are LRU-evicted to
+    keep the total (vectors plus passage text) under `budget_bytes`.
+    """
+
+    def __init__(self, max_chunks: int, budget_bytes: int):
+        self.max_chunks = max_chunks
+        self.budget = budget_bytes
+        self.entries: "OrderedDict[str, Optional[dict]]" = OrderedDict()
+        self.generations: Dict[str, int] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.nbytes = 0
+
+    async def search(self, user_id: str, query_vector: np.ndarray, top_k: int) -> Optional[List[dict]]:
+        """
+        Top-k passages from the in-memory index, or None when the caller should use Postgres.
+        A pool connection is only taken to load a user's index.
+        """
+        metrics.inc("inquiro_cache_requests_total", {"cache": "vector", "result": "hit" if user_id in self.entries else "miss"})
+        if user_id not in self.entries:
+            async with self.locks.setdefault(user_id, asyncio.Lock()):
+                if user_id not in self.entries:
+                    async with db_connection() as conn:
+                        await self.load(conn, user_id)
+            if user_id not in self.entries:
+                self.forget(user_id)  # invalidated while loading
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        self.entries.move_to_end(user_id)
+
+        scores = entry["matrix"] @ np.asarray(query_vector, dtype=np.float32)
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {
+                "chunk_id": entry["chunk_ids"][i],
+                "id": entry["document_ids"][i],
+                "title": entry["titles"][i],
+                "content": entry["contents"][i],
+                "chunk_index": entry["chunk_indexes"][i],
+            }
+            for i in top
+        ]
 
-        async with pool.acquire() as conn:
-            # 1. Fetch similar documents
+    async def load(self, conn: asyncpg.Connection, user_id: str) -> None:
+        generation = self.generations.get(user_id, 0)
+        count = await conn.fetchval("SELECT count(*) FROM document_chunks WHERE user_id = $1", uuid.UUID(user_id))
+        entry = None
+        if 0 < count <= self.max_chunks:
             rows = await conn.fetch(
-                "SELECT id, title, content FROM document WHERE user_id = $1 ORDER BY embedding <=> $2::vector LIMIT 3",
-                uuid.UUID(user_id), query_embedding_str
+                "SELECT c.chunk_id, c.document_id, d.title, c.content, c.chunk_index, c.embedding "
+                "FROM document_chunks c JOIN document d ON d.id = c.document_id WHERE c.user_id = $1",
+                uuid.UUID(user_id)
             )
+            matrix = np.ascontiguousarray(np.vstack([row['embedding'] for row in rows]), dtype=np.float32)
+            contents = [row['content'] for row in rows]
+            entry = {
+                "matrix": matrix,
+                "chunk_ids": [row['chunk_id'] for row in rows],
+                "document_ids": [row['document_id'] for row in rows],
+                "titles": [row['title'] for row in rows],
+                "contents": contents,
+                "chunk_indexes": [row['chunk_index'] for row in rows],
+                "nbytes": matrix.nbytes + sum(map(len, contents)),
+            }
+        if self.generations.get(user_id, 0) != generation:
+            return  # invalidated while loading
+        if entry and entry["nbytes"] > self.budget:
+            entry = None
+        # None marks users whose corpus is empty or too large to hold in memory
+        self.evict(user_id)
+        self.entries[user_id] = entry
+        self.nbytes += entry["nbytes"] if entry else 0
+        while self.nbytes > self.budget and len(self.entries) > 1:
+            self.evict(next(iter(self.entries)))
 
-            # 2. Prepare prompt
-            context = "\n".join([f"Document: {row['title']}\nContent: {row['content']}" for row in rows])
-            prompt = (
-                "You are a helpful assistant answering questions based solely on the provided document content. "
-                "Do not use any external knowledge or make assumptions beyond the given context. "
-                "If the context does not contain enough information to answer the question, respond with: "
-                "\"The provided documents do not contain enough information to answer this question.\" "
-                f"\n\nDocument content:\n{context}\n\nQuestion: {query.question}"
-            )
-            response = genai.GenerativeModel("gemini-1.5-flash").generate_content(prompt)
+    def evict(self, user_id: str) -> None:
+        entry = self.entries.pop(user_id, None)
+        if entry:
+            self.nbytes -= entry["nbytes"]
+        self.forget(user_id)
 
-            # 3. Insert query into DB (inside the same `with` block)
-            query_id = uuid.uuid4()
-            document_id = rows[0]['id'] if rows else None
-            if document_id:
-                await conn.execute(
-                    "INSERT INTO queries(query_id, user_id, id, question, response) "
-                    "VALUES ($1, $2, $3, $4, $5)",
-                    query_id, uuid.UUID(user_id), document_id, query.question, response.text)
-
-        # 4. Return result (outside the block)
-        documents = [
-            {"id": str(row["id"]), "title": row["title"], "content": row["content"][:2000]}
-            for row in rows
-        ]
+    def invalidate(self, user_id: str) -> None:
+        self.generations[user_id] = self.generations.get(user_id, 0) + 1
+        self.evict(user_id)
+
+    def forget(self, user_id: str) -> None:
+        """
+        Drop the user's lock and generation once nothing is cached or loading,
+        so departed users do not accumulate. A load in progress still needs
+        its generation to notice an invalidation.
+        """
+        lock = self.locks.get(user_id)
+        if user_id in self.entries or (lock and lock.locked()):
+            return
+        self.locks.pop(user_id, None)
+        self.generations.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "users": sum(1 for entry in self.entries.values() if entry),
+            "bytes": self.nbytes,
+            "budget_bytes": self.budget,
+        }
+
+vector_cache = VectorIndexCache(VECTOR_CACHE_MAX_CHUNKS, VECTOR_CACHE_BUDGET_MB * 1024 * 1024)
+
+async def search_chunks(user_id: str, query_vector: np.ndarray, top_k: int = QUERY_TOP_K_CHUNKS):
+    """
+    Retrieve passages from the in-memory index when possible, otherwise from Postgres.
+    Index hits never wait for a pool connection.
+    """
+    if VECTOR_CACHE_ENABLED:
+        rows = await vector_cache.search(user_id, query_vector, top_k)
+        if rows is not None:
+            return rows
+    async with db_connection() as conn:
+        return await retrieve_chunks(conn, user_id, query_vector, top_k)
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+def shingles(text: str, size: int = 5) -> set:
+    words = text.lower().split()
+    return {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+def build_context(passages: List, budget_tokens: int, overlap_threshold: float = 0.8) -> Tuple[List, int]:
+    """
+    Greedily pack passages, highest priority first, into `budget_tokens`.
+    A passage is skipped when most of its word 5-grams already appear in the
+    packed text, which drops duplicates and chunks overlapping earlier ones.
+    Returns the kept passages in priority order and the tokens they use.
+    """
+    selected = []
+    seen = set()
+    used = 0
+    for passage in passages:
+        content = passage['content']
+        cost = estimate_tokens(content)
+        if used + cost > budget_tokens:
+            continue
+        grams = shingles(content)
+        if grams and len(grams & seen) / len(grams) >= overlap_threshold:
+            continue
+        selected.append(passage)
+        seen |= grams
+        used += cost
+    return selected, used
+
+def coverage_order(count: int) -> List[int]:
+    """
+    Indexes 0..count-1 ordered coarse-to-fine (middle, quarters, eighths, ...),
+    so any prefix samples the whole document evenly.
+    """
+    order = []
+    seen = set()
+    step = count
+    while len(order) < count:
+        for index in range(step // 2, count, max(step, 1)):
+            if index not in seen:
+                seen.add(index)
+                order.append(index)
+        step = max(step // 2, 1)
+    return order
+
+def group_passages(rows) -> List[dict]:
+    """
+    Collapse retrieved passages into one entry per document, keeping the rank order.
+    """
+    grouped = {}
+    for row in rows:
+        entry = grouped.setdefault(row['id'], {"id": row['id'], "title": row['title'], "passages": []})
+        entry["passages"].append(row['content'])
+    return list(grouped.values())
+
+class AnswerCache:
+    """
+    Semantic cache of Gemini answers. Entries are bucketed by user and the exact
+    set of retrieved passages; within a bucket a stored answer is served when the
+    question embeddings are at least `threshold` cosine-similar.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int, threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.threshold = threshold
+        self.entries: "OrderedDict[uuid.UUID, dict]" = OrderedDict()
+        self.buckets: Dict[Tuple[str, frozenset], List[uuid.UUID]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+
+    def lookup(self, user_id: str, embedding: np.ndarray, source_ids: List) -> Optional[str]:
+        if self.max_entries <= 0:
+            return None
+        now = time.monotonic()
+        for entry_id in list(self.buckets.get((user_id, frozenset(source_ids)), [])):
+            entry = self.entries[entry_id]
+            if now - entry["created"] > self.ttl:
+                self.remove(entry_id)
+                continue
+            if float(np.dot(entry["embedding"], embedding)) >= self.threshold:
+                self.entries.move_to_end(entry_id)
+                self.hits += 1
+                self.saved_ms += entry["llm_ms"]
+                metrics.inc("inquiro_cache_requests_total", {"cache": "answer", "result": "hit"})
+                return entry["answer"]
+        self.misses += 1
+        metrics.inc("inquiro_cache_requests_total", {"cache": "answer", "result": "miss"})
+        return None
+
+    def store(self, user_id: str, embedding: np.ndarray, source_ids: List, document_ids: List, answer: str, llm_ms: float) -> None:
+        if self.max_entries <= 0:
+            return
+        entry_id = uuid.uuid4()
+        key = (user_id, frozenset(source_ids))
+        self.entries[entry_id] = {
+            "key": key,
+            "embedding": np.asarray(embedding, dtype=np.float32),
+            "document_ids": set(document_ids),
+            "answer": answer,
+            "llm_ms": llm_ms,
+            "created": time.monotonic(),
+        }
+        self.buckets.setdefault(key, []).append(entry_id)
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, entry_id: uuid.UUID) -> None:
+        entry = self.entries.pop(entry_id, None)
+        if not entry:
+            return
+        bucket = self.buckets.get(entry["key"], [])
+        if entry_id in bucket:
+            bucket.remove(entry_id)
+        if not bucket:
+            self.buckets.pop(entry["key"], None)
+
+    def invalidate_document(self, document_id) -> None:
+        for entry_id, entry in list(self.entries.items()):
+            if document_id in entry["document_ids"]:
+                self.remove(entry_id)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "latency_saved_ms": round(self.saved_ms, 1),
+        }
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_THRESHOLD)
+
+def apply_invalidation(user_id: str, document_id: Optional[uuid.UUID] = None) -> None:
+    vector_cache.invalidate(user_id)
+    if document_id:
+        answer_cache.invalidate_document(document_id)
+
+async def invalidate_caches(conn: asyncpg.Connection, user_id: str, document_id: Optional[uuid.UUID] = None) -> None:
+    """
+    Drop cached state for a user's changed corpus here and, with SHARED_STATE,
+    in every other worker through a Postgres notification.
+    """
+    apply_invalidation(user_id, document_id)
+    if SHARED_STATE:
+        await conn.execute(
+            "SELECT pg_notify($1, $2)", CACHE_CHANNEL,
+            json.dumps({"user_id": user_id, "document_id": str(document_id) if document_id else None})
+        )
+
+cache_listener: Optional[asyncpg.Connection] = None
+
+def on_cache_notification(connection, pid, channel, payload) -> None:
+    message = json.loads(payload)
+    document_id = message.get("document_id")
+    apply_invalidation(message["user_id"], uuid.UUID(document_id) if document_id else None)
+
+async def start_cache_listener() -> None:
+    global cache_listener
+    if not SHARED_STATE:
+        return
+    # LISTEN needs its own connection; a pooled one would be handed to other callers
+    cache_listener = await asyncpg.connect(DATABASE_URL)
+    await cache_listener.add_listener(CACHE_CHANNEL, on_cache_notification)
+
+async def stop_cache_listener() -> None:
+    global cache_listener
+    if cache_listener:
+        await cache_listener.close()
+        cache_listener = None
+
+# Errors caused by the rows themselves (bad values, constraint violations);
+# retrying the same rows cannot succeed
+ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError, ValueError)
+
+async def write_rows(conn: asyncpg.Connection, sql: str, rows: List[tuple]) -> List[Tuple[tuple, Exception]]:
+    """
+    executemany `rows`, falling back to one row at a time when the batch is
+    refused for its data, so one bad row cannot hold back the rest. Returns
+    the refused rows with their errors; any other error propagates.
+    """
+    try:
+        await conn.executemany(sql, rows)
+        return []
+    except ROW_ERRORS as e:
+        logger.warning("Batch of %d rows refused (%s); writing them one at a time", len(rows), e)
+    rejected = []
+    for row in rows:
+        try:
+            await conn.execute(sql, *row)
+        except ROW_ERRORS as e:
+            rejected.append((row, e))
+    return rejected
+
+class QueryLogBuffer:
+    """
+    Write-behind buffer for the queries table. Rows are flushed in one batch
+    when `batch_size` rows are waiting or every `interval_seconds`, and once
+    more on shutdown. Rows Postgres refuses are dropped and counted; batches
+    that fail otherwise are retried up to `max_retries` flushes in a row.
+    Past `max_rows` the oldest rows are dropped.
+    """
+
+    def __init__(self, batch_size: int, interval_seconds: float, max_rows: int, max_retries: int):
+        self.batch_size = batch_size
+        self.interval = interval_seconds
+        self.max_rows = max_rows
+        self.max_retries = max_retries
+        self.rows: List[tuple] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = False
+        self.failures = 0
+        self.flushed = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        # Signal rather than cancel: a flush in progress has already taken its
+        # rows out of the buffer, and cancelling it would lose them
+        if self.task:
+            self.stopping = True
+            self.wakeup.set()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    def enqueue(self, query_id: uuid.UUID, user_id: str, document_id: uuid.UUID, question: str, response: str) -> None:
+        self.rows.append((query_id, uuid.UUID(user_id), document_id, question, response))
+        self.trim()
+        if len(self.rows) >= self.batch_size and self.wakeup:
+            self.wakeup.set()
+
+    def trim(self) -> None:
+        if len(self.rows) > self.max_rows:
+            overflow = len(self.rows) - self.max_rows
+            del self.rows[:overflow]
+            self.dropped += overflow
+
+    async def run(self) -> None:
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self.rows or not pool:
+            return
+        batch, self.rows = self.rows, []
+        try:
+            async with db_connection() as conn:
+                rejected = await write_rows(
+                    conn,
+                    "INSERT INTO queries(query_id, user_id, id, question, response) VALUES ($1, $2, $3, $4, $5)",
+                    batch
+                )
+        except Exception as e:
+            self.failures += 1
+            if self.failures > self.max_retries:
+                logger.error("Dropping %d query log rows after %d failed flushes: %s", len(batch), self.failures, e)
+                self.dropped += len(batch)
+                self.failures = 0
+            else:
+                logger.error("Error flushing %d query log rows, will retry: %s", len(batch), e)
+                self.rows = batch + self.rows
+                self.trim()
+            return
+        self.failures = 0
+        for row, error in rejected:
+            logger.error("Query log row %s refused, dropping it: %s", row[0], error)
+        self.rejected += len(rejected)
+        self.flushed += len(batch) - len(rejected)
+
+    def stats(self) -> dict:
+        return {"depth": len(self.rows), "flushed": self.flushed, "rejected": self.rejected, "dropped": self.dropped}
+
+query_log = QueryLogBuffer(QUERY_LOG_BATCH_SIZE, QUERY_LOG_FLUSH_SECONDS, QUERY_LOG_MAX_ROWS, WRITE_BEHIND_MAX_RETRIES)
+
+class JobMirror:
+    """
+    Copies ingestion job status to the ingestion_job table, so /jobs/{id}
+    answers on any worker. New jobs are written before their id is returned
+    (publish); progress updates follow every `interval_seconds`, retried up
+    to `max_retries` flushes in a row. A no-op unless SHARED_STATE is on.
+    """
+
+    def __init__(self, interval_seconds: float, enabled: bool, max_retries: int):
+        self.interval = interval_seconds
+        self.enabled = enabled
+        self.max_retries = max_retries
+        self.dirty: Dict[str, dict] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.failures = 0
+        self.last_pruned = 0.0
+
+    def start(self) -> None:
+        if self.enabled:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+            await self.flush()
+
+    def mark(self, job: dict) -> None:
+        if self.enabled:
+            self.dirty[job["job_id"]] = job
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def publish(self, jobs: List[dict]) -> None:
+        """
+        Write new jobs now, so a status poll that lands on another worker
+        finds them. On failure they stay queued for the next flush.
+        """
+        if not self.enabled or not jobs or not pool:
+            return
+        batch = {job["job_id"]: self.dirty.pop(job["job_id"], job) for job in jobs}
+        try:
+            await self.write(batch)
+        except Exception as e:
+            logger.error("Error publishing %d ingestion jobs: %s", len(batch), e)
+            self.dirty = {**batch, **self.dirty}
+
+    async def flush(self) -> None:
+        if not self.dirty or not pool:
+            return
+        batch, self.dirty = self.dirty, {}
+        try:
+            await self.write(batch)
+        except Exception as e:
+            self.failures += 1
+            if self.failures > self.max_retries:
+                logger.error("Dropping status for %d ingestion jobs after %d failed flushes: %s", len(batch), self.failures, e)
+                self.failures = 0
+            else:
+                logger.error("Error mirroring %d ingestion jobs, will retry: %s", len(batch), e)
+                # Jobs updated meanwhile keep their newer state
+                self.dirty = {**batch, **self.dirty}
+            return
+        self.failures = 0
+
+    async def write(self, batch: Dict[str, dict]) -> None:
+        async with db_connection() as conn:
+            rejected = await write_rows(
+                conn,
+                "INSERT INTO ingestion_job(job_id, user_id, state, updated_at) VALUES ($1, $2, $3::jsonb, $4) "
+                "ON CONFLICT (job_id) DO UPDATE SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at",
+                [
+                    (uuid.UUID(job_id), uuid.UUID(job["user_id"]), json.dumps(job_response(job)), job["updated_at"])
+                    for job_id, job in batch.items()
+                ]
+            )
+            if time.monotonic() - self.last_pruned > JOB_RETENTION_SECONDS / 10:
+                self.last_pruned = time.monotonic()
+                await conn.execute(
+                    "DELETE FROM ingestion_job WHERE updated_at < $1",
+                    datetime.utcnow() - timedelta(seconds=JOB_RETENTION_SECONDS)
+                )
+        for row, error in rejected:
+            logger.error("Status for ingestion job %s refused, dropping it: %s", row[0], error)
+
+    async def fetch(self, job_id: str, user_id: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        try:
+            job_uuid = uuid.UUID(job_id)
+        except ValueError:
+            return None
+        async with db_connection() as conn:
+            state = await conn.fetchval(
+                "SELECT state FROM ingestion_job WHERE job_id = $1 AND user_id = $2", job_uuid, uuid.UUID(user_id)
+            )
+        return json.loads(state) if state else None
+
+job_mirror = JobMirror(JOB_MIRROR_SECONDS, SHARED_STATE, WRITE_BEHIND_MAX_RETRIES)
+
+def build_query_prompt(question: str, sources: List[dict]) -> str:
+    context = "\n".join(
+        [f"Document: {src['title']}\nContent: " + "\n".join(src['passages']) for src in sources]
+    )
+    return (
+        "You are a helpful assistant answering questions based solely on the provided document content. "
+        "Do not use any external knowledge or make assumptions beyond the given context. "
+        "If the context does not contain enough information to answer the question, respond with: "
+        "\"The provided documents do not contain enough information to answer this question.\" "
+        f"\n\nDocument content:\n{context}\n\nQuestion: {question}"
+    )
+
+def source_documents(sources: List[dict]) -> List[dict]:
+    return [
+        {"id": str(src["id"]), "title": src["title"], "content": "\n".join(src["passages"])[:2000]}
+        for src in sources
+    ]
+
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+class LLMBusyError(HTTPException):
+    """
+    429 raised by the LLM gateway when its queue is full or a caller waited too long.
+    """
+
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=detail,
+            headers={"Retry-After": str(max(1, round(retry_after)))}
+        )
+
+class SharedStream:
+    """
+    One upstream token stream replayed to every caller that asked for the same prompt.
+    """
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.changed = asyncio.Event()
+        self.followers = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def push(self, text: str) -> None:
+        self.parts.append(text)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def close(self, error: Optional[Exception] = None) -> None:
+        self.error = error
+        self.done = True
+        self.changed.set()
+
+    async def follow(self):
+        self.followers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(self.parts):
+                    yield self.parts[index]
+                    index += 1
+                if self.done:
+                    if self.error:
+                        raise self.error
+                    return
+                await self.changed.wait()
+        finally:
+            self.followers -= 1
+            # Nobody is listening any more; stop paying for the upstream call
+            if self.followers == 0 and not self.done and self.task:
+                self.task.cancel()
+
+class LLMGateway:
+    """
+    Shared front door for Gemini calls: at most `max_concurrency` calls in
+    flight, a tokens-per-minute budget, and a wait queue of `max_queue`
+    callers beyond which requests fail fast with 429. Identical in-flight
+    prompts (and identical coalesce() keys) share a single upstream call.
+    """
+
+    def __init__(self, model_name: str, max_concurrency: int, tokens_per_minute: int, max_queue: int, max_wait_seconds: float):
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.max_wait = max_wait_seconds
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.tokens = float(tokens_per_minute)
+        self.refilled = time.monotonic()
+        self.inflight: Dict[object, asyncio.Task] = {}
+        self.waiters: Dict[object, int] = {}
+        self.streams: Dict[str, SharedStream] = {}
+        self.waiting = 0
+        self.running = 0
+        self.calls = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.wait_seconds = 0.0
+        self.last_wait_ms = 0.0
+
+    def admit(self) -> None:
+        """
+        Fail fast when the wait queue is already full.
+        """
+        # Callers beyond the concurrency limit are the ones actually queued
+        if self.waiting + self.running - self.max_concurrency >= self.max_queue:
+            self.rejected += 1
+            metrics.inc("inquiro_llm_rejected_total", {"reason": "queue_full"})
+            raise LLMBusyError(
+                "The assistant is busy, please retry shortly", self.max_queue / max(self.max_concurrency, 1)
+            )
+
+    async def take_tokens(self, cost: int) -> None:
+        if self.tokens_per_minute <= 0:
+            return
+        cost = min(cost, self.tokens_per_minute)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.tokens_per_minute, self.tokens + (now - self.refilled) * self.tokens_per_minute / 60)
+            self.refilled = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return
+            await asyncio.sleep((cost - self.tokens) * 60 / self.tokens_per_minute)
+
+    async def acquire(self, cost: int) -> None:
+        await self.semaphore.acquire()
+        try:
+            await self.take_tokens(cost)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    @asynccontextmanager
+    async def slot(self, prompt: str):
+        self.admit()
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.acquire(estimate_tokens(prompt) + LLM_OUTPUT_TOKENS), self.max_wait)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            metrics.inc("inquiro_llm_rejected_total", {"reason": "timeout"})
+            raise LLMBusyError("Timed out waiting for the assistant, please retry", self.max_wait)
+        finally:
+            self.waiting -= 1
+            waited = time.perf_counter() - started
+            self.wait_seconds += waited
+            self.last_wait_ms = round(waited * 1000, 2)
+            record_stage("llm_queue_wait", waited)
+        self.running += 1
+        self.calls += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+    async def coalesce(self, key, factory):
+        """
+        Await `factory()`, or the already running call with the same key. The
+        call is shielded so one caller disconnecting does not fail the others,
+        and cancelled once the last caller has gone.
+        """
+        task = self.inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(factory())
+            self.inflight[key] = task
+
+            def finished(done: asyncio.Task) -> None:
+                if self.inflight.get(key) is done:
+                    del self.inflight[key]
+                    self.waiters.pop(key, None)
+                if not done.cancelled():
+                    done.exception()  # retrieved here in case every caller went away
+
+            task.add_done_callback(finished)
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self.inflight.get(key) is task:
+                self.waiters[key] -= 1
+                # Nobody is waiting any more; stop paying for the upstream call
+                if self.waiters[key] == 0 and not task.done():
+                    del self.inflight[key]
+                    del self.waiters[key]
+                    task.cancel()
+
+    async def generate(self, prompt: str) -> str:
+        key = ("generate", hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+        return await self.coalesce(key, lambda: self.call(prompt))
+
+    async def call(self, prompt: str) -> str:
+        async with self.slot(prompt):
+            with timed("llm"):
+                response = await genai.GenerativeModel(self.model_name).generate_content_async(prompt)
+            return response.text
+
+    def stream(self, prompt: str):
+        """
+        Async iterator of text parts; joins an identical stream already in flight.
+        """
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        shared = self.streams.get(key)
+        if shared:
+            self.coalesced += 1
+        else:
+            shared = self.streams[key] = SharedStream()
+            shared.task = asyncio.create_task(self.run_stream(key, prompt, shared))
+        return shared.follow()
+
+    async def run_stream(self, key: str, prompt: str, shared: SharedStream) -> None:
+        error = None
+        try:
+            async with self.slot(prompt):
+                with timed("llm"):
+                    response = await genai.GenerativeModel(self.model_name).generate_content_async(prompt, stream=True)
+                    async for chunk in response:
+                        if chunk.text:
+                            shared.push(chunk.text)
+        except Exception as e:
+            error = e
+        finally:
+            self.streams.pop(key, None)
+            shared.close(error)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.running,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "tokens_available": round(self.tokens) if self.tokens_per_minute > 0 else -1,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "coalesced": self.coalesced,
+            "avg_wait_ms": round(self.wait_seconds / self.calls * 1000, 2) if self.calls else 0.0,
+            "last_wait_ms": self.last_wait_ms,
+        }
+
+llm_gateway = LLMGateway(LLM_MODEL, LLM_MAX_CONCURRENCY, LLM_TOKENS_PER_MINUTE, LLM_MAX_QUEUE, LLM_MAX_WAIT_SECONDS)
+
+
+# User APIs
+@app.post("/register")
+async def register_user(user: UserCreate):
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not initialized")
+    
+    try:
+        password_hash = await hash_password(user.password)
+        async with db_connection() as conn:
+            try:
+                user_id = uuid.uuid4()
+                await conn.execute(
+                    "INSERT INTO users(user_id, username, email, password_hash, created_at) VALUES ($1, $2, $3, $4, $5)",
+                    user_id, user.username, user.email, password_hash, datetime.utcnow()
+                )
+                return {"message": "User registered successfully", "user_id": str(user_id)}
+            except asyncpg.UniqueViolationError:
+                raise HTTPException(status_code=400, detail="Username or email already exists")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to register user: {str(e)}")
+
+@app.post("/login")
+async def login_user(form_data: OAuth2PasswordRequestForm = Depends()):
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not initialized")
+    
+    try:
+        async with db_connection() as conn:
+            user = await conn.fetchrow(
+                "SELECT user_id, password_hash FROM users WHERE username = $1", form_data.username
+            )
+        # Verify after releasing the connection; bcrypt takes far longer than the lookup
+        if not user or not await verify_password(form_data.password, user['password_hash']):
+            raise HTTPException(status_code=401, detail="Invalid username or password")
+        access_token = create_access_token(data={"sub": str(user['user_id'])})
+        return {"access_token": access_token, "token_type": "bearer"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to login: {str(e)}")
+
+# Document APIs
+# Background ingestion: /upload spools the file and enqueues a job; workers
+# parse and chunk in a process pool, embed in a thread and write at the end.
+ingestion_queue: Optional[asyncio.Queue] = None
+ingestion_executor: Optional[ProcessPoolExecutor] = None
+ocr_executor: Optional[ProcessPoolExecutor] = None
+ingestion_workers: List[asyncio.Task] = []
+ingestion_jobs: Dict[str, dict] = {}
+
+def spool_pages(page_texts: Iterable[Optional[str]], spool) -> Iterator[Optional[str]]:
+    """
+    Pass page texts through, writing each to `spool` as one JSON line.
+    """
+    for text in page_texts:
+        spool.write(json.dumps(text) + "\n")
+        yield text
+
+def parse_pdf_file(path: str) -> Tuple[int, List[str], List[str], List[Tuple[int, int]], Optional[str]]:
+    """
+    Parse a spooled PDF and chunk it. Runs inside the ingestion process pool.
+    Returns the page count, the chunks, a text hash per page, the textless
+    pages to OCR and, when there are any, a file holding every page's text
+    for chunk_spooled_pages, so the PDF is not extracted a second time.
+    """
+    # Pass an open handle: given a path, PdfReader reads the whole file into memory
+    with open(path, "rb") as stream:
+        try:
+            reader = PyPDF2.PdfReader(stream)
+            logger.debug("PDF loaded successfully. Pages: %d", len(reader.pages))
+        except Exception as pdf_error:
+            raise ValueError(f"Failed to read PDF file. The file may be corrupted. Error: {str(pdf_error)}")
+
+        page_state = {"hashes": [], "textless": []}
+        page_texts = iter_page_texts(reader, page_state)
+        spool = None
+        if OCR_ENABLED:
+            spool = tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix="inquiro-pages-", suffix=".jsonl", delete=False)
+            page_texts = spool_pages(page_texts, spool)
+        try:
+            try:
+                chunks = extract_text_chunks(page_texts)
+            except Exception as chunk_error:
+                # A fully scanned PDF has no text yet; let the OCR stage have a go first
+                if not (spool and page_state["textless"] and len(page_state["hashes"]) == len(reader.pages)):
+                    raise ValueError(f"Failed to extract text: {str(chunk_error)}")
+                chunks = []
+        except BaseException:
+            if spool:
+                spool.close()
+                os.remove(spool.name)
+            raise
+
+        spool_path = None
+        if spool:
+            spool.close()
+            if page_state["textless"]:
+                spool_path = spool.name
+            else:
+                os.remove(spool.name)
+        return len(reader.pages), chunks, page_state["hashes"], page_state["textless"], spool_path
+
+def chunk_spooled_pages(spool_path: str, ocr_text: Dict[int, str]) -> Tuple[List[str], List[str]]:
+    """
+    Chunk the first pass's page texts with OCR text spliced into the textless
+    pages. Runs inside the ingestion process pool. Returns the chunks and a
+    text hash per page.
+    """
+    hashes = []
+
+    def page_texts() -> Iterator[Optional[str]]:
+        with open(spool_path, encoding="utf-8") as spool:
+            for page_number, line in enumerate(spool, start=1):
+                text = ocr_text[page_number] if page_number in ocr_text else json.loads(line)
+                hashes.append(hashlib.sha256((text or "").encode("utf-8")).hexdigest())
+                yield text
+
+    try:
+        chunks = extract_text_chunks(page_texts())
+    except Exception as chunk_error:
+        raise ValueError(f"Failed to extract text: {str(chunk_error)}")
+    return chunks, hashes
+
+async def run_ocr(job: dict, path: str, pages: List[Tuple[int, int]]) -> Dict[int, str]:
+    """
+    OCR the given (page_number, dpi) pages across the OCR process pool.
+    """
+    loop = asyncio.get_running_loop()
+    update_job(job, status="ocr")
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(loop.run_in_executor(ocr_executor, ocr_page, path, page_number, dpi) for page_number, dpi in pages),
+        return_exceptions=True
+    )
+    ocr_text = {}
+    timings = {}
+    for (page_number, _), result in zip(pages, results):
+        if isinstance(result, Exception):
+            logger.warning("OCR failed on page %d: %s", page_number, result)
+            ocr_text[page_number] = ""
+            continue
+        _, text, seconds = result
+        record_stage("ocr_page", seconds)
+        logger.debug("Page %d: OCR extracted %d characters in %.2fs", page_number, len(text), seconds)
+        ocr_text[page_number] = text
+        timings[page_number] = round(seconds, 3)
+    wall_seconds = time.perf_counter() - started
+    record_stage("ocr", wall_seconds)
+    job["ocr"] = {
+        "pages": len(pages),
+        "wall_seconds": round(wall_seconds, 3),
+        "page_seconds": timings,
+    }
+    return ocr_text
+
+def create_job(user_id: str, filename: str, document_id: Optional[str] = None) -> dict:
+    """
+    Register an ingestion job. With `document_id` the job updates that document in place.
+    """
+    prune_jobs()
+    now = datetime.utcnow()
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "filename": filename,
+        "mode": "update" if document_id else "create",
+        "status": "queued",
+        "progress": 0.0,
+        "document_id": document_id,
+        "stats": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+    ingestion_jobs[job["job_id"]] = job
+    job_mirror.mark(job)
+    return job
+
+def update_job(job: dict, **fields) -> None:
+    job.update(fields, updated_at=datetime.utcnow())
+    job_mirror.mark(job)
+
+def prune_jobs() -> None:
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_RETENTION_SECONDS)
+    for job_id, job in list(ingestion_jobs.items()):
+        if job["status"] in ("completed", "failed") and job["updated_at"] < cutoff:
+            del ingestion_jobs[job_id]
+
+def job_pending(user_id: str, filename: str) -> bool:
+    return any(
+        job["user_id"] == user_id and job["filename"] == filename and job["status"] not in ("completed", "failed")
+        for job in ingestion_jobs.values()
+    )
+
+async def enqueue_upload(file: UploadFile, user_id: str, filename: str, document_id: Optional[str] = None) -> dict:
+    if ingestion_queue.full():
+        raise HTTPException(status_code=503, detail="Upload queue is full, please retry shortly")
+
+    path, content_hash = await asyncio.to_thread(spool_upload, file)
+    job = create_job(user_id, filename, document_id)
+    try:
+        ingestion_queue.put_nowait((job, path, content_hash))
+    except asyncio.QueueFull:
+        os.remove(path)
+        del ingestion_jobs[job["job_id"]]
+        raise HTTPException(status_code=503, detail="Upload queue is full, please retry shortly")
+    await job_mirror.publish([job])
+    return job
+
+async def start_ingestion() -> None:
+    global ingestion_queue, ingestion_executor, ocr_executor
+    ingestion_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    ingestion_executor = ProcessPoolExecutor(max_workers=INGEST_PROCESSES)
+    if OCR_ENABLED:
+        ocr_executor = ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=init_ocr_worker)
+    for _ in range(INGEST_WORKERS):
+        ingestion_workers.append(asyncio.create_task(ingestion_worker()))
+
+async def stop_ingestion() -> None:
+    for task in ingestion_workers:
+        task.cancel()
+    await asyncio.gather(*ingestion_workers, return_exceptions=True)
+    ingestion_workers.clear()
+    for task in batch_pipelines:
+        task.cancel()
+    await asyncio.gather(*batch_pipelines, return_exceptions=True)
+    batch_pipelines.clear()
+    if ingestion_executor:
+        ingestion_executor.shutdown(wait=False, cancel_futures=True)
+    if ocr_executor:
+        ocr_executor.shutdown(wait=False, cancel_futures=True)
+
+async def ingestion_worker() -> None:
+    while True:
+        job, path, content_hash = await ingestion_queue.get()
+        try:
+            await process_ingestion_job(job, path, content_hash)
+        except Exception as e:
+            logger.exception("Ingestion job %s failed: %s", job["job_id"], e)
+            update_job(job, status="failed", error=str(e))
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            ingestion_queue.task_done()
+
+async def embed_with_progress(job: dict, chunks: List[str], start: float, end: float) -> np.ndarray:
+    """
+    Embed in slices so progress can be reported between them.
+    """
+    await embedder_ready.wait()
+    slice_size = EMBED_BATCH_SIZE * 4
+    parts = []
+    for offset in range(0, len(chunks), slice_size):
+        with timed("embedding"):
+            parts.append(await asyncio.to_thread(embed_chunks, chunks[offset:offset + slice_size]))
+        done = min(offset + slice_size, len(chunks))
+        update_job(job, progress=start + (end - start) * done / len(chunks))
+    return np.vstack(parts) if parts else np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+async def clone_identical(job: dict, content_hash: str) -> bool:
+    """
+    Finish `job` by copying an identical, already-ingested file (by anyone).
+    Returns False when there is none and the file has to be processed.
+    """
+    async with db_connection() as conn:
+        source_id = await conn.fetchval(
+            "SELECT id FROM document WHERE content_hash = $1 LIMIT 1", content_hash
+        )
+        if not source_id:
+            return False
+        update_job(job, status="saving", progress=0.5)
+        if await title_taken(conn, job["user_id"], job["filename"]):
+            update_job(job, status="failed", error="A file with this name already exists")
+            return True
+        doc_id, stats = await clone_document(conn, source_id, job["user_id"], job["filename"])
+        await invalidate_caches(conn, job["user_id"])
+    update_job(job, status="completed", progress=1.0, document_id=str(doc_id), stats={**stats, "reused_from_identical_file": True})
+    return True
+
+async def parse_upload(job: dict, path: str) -> Optional[dict]:
+    """
+    Parse, OCR and chunk a spooled upload off the event loop. Returns the page
+    count, chunks, page hashes and stats, or None after failing the job.
+    """
+    loop = asyncio.get_running_loop()
+    update_job(job, status="parsing", progress=0.05)
+    spool_path = None
+    try:
+        with timed("pdf_parse"):
+            page_count, chunks, page_hashes, textless_pages, spool_path = await loop.run_in_executor(
+                ingestion_executor, parse_pdf_file, path
+            )
+        # Scanned pages: OCR only those, then chunk the spooled page texts again with theirs filled in
+        if spool_path:
+            ocr_text = await run_ocr(job, path, textless_pages)
+            update_job(job, status="parsing", progress=0.25)
+            with timed("pdf_parse"):
+                chunks, page_hashes = await loop.run_in_executor(
+                    ingestion_executor, chunk_spooled_pages, spool_path, ocr_text
+                )
+    except ValueError as parse_error:
+        update_job(job, status="failed", error=str(parse_error))
+        return None
+    finally:
+        if spool_path:
+            try:
+                os.remove(spool_path)
+            except OSError:
+                pass
+
+    if not chunks:
+        update_job(job, status="failed", error="No readable text content found in the PDF. This might be a scanned document or image-based PDF.")
+        return None
+
+    # Chunks are stripped and non-empty, so the joined length is known without joining
+    total_characters = sum(map(len, chunks)) + len(chunks) - 1
+    if total_characters < 100:
+        update_job(job, status="failed", error=f"Insufficient content extracted ({total_characters} characters). Please ensure the PDF contains substantial readable text.")
+        return None
+
+    logger.info("Successfully extracted %d characters from PDF", total_characters)
+    stats = {"pages": page_count, "chunks": len(chunks), "total_characters": total_characters}
+    if "ocr" in job:
+        stats["ocr"] = job["ocr"]
+    return {"page_count": page_count, "chunks": chunks, "page_hashes": page_hashes, "stats": stats}
+
+async def process_ingestion_job(job: dict, path: str, content_hash: str) -> None:
+    # 0. An identical file was already ingested: reuse its chunks and embeddings
+    if job["mode"] == "create" and await clone_identical(job, content_hash):
+        return
+
+    # 1. Parse and chunk off the event loop
+    parsed = await parse_upload(job, path)
+    if not parsed:
+        return
+    page_count, chunks, page_hashes, stats = parsed["page_count"], parsed["chunks"], parsed["page_hashes"], parsed["stats"]
+
+    # 2. For updates, find changed pages and the embeddings that can be kept
+    reusable = {}
+    if job["mode"] == "update":
+        async with db_connection() as conn:
+            previous = await conn.fetchrow(
+                "SELECT page_hashes FROM document WHERE id = $1 AND user_id = $2",
+                uuid.UUID(job["document_id"]), uuid.UUID(job["user_id"])
+            )
+            if not previous:
+                update_job(job, status="failed", error="Document not found")
+                return
+            old_hashes = previous['page_hashes'] or []
+            changed_pages = [
+                page + 1 for page in range(max(len(old_hashes), len(page_hashes)))
+                if page >= len(old_hashes) or page >= len(page_hashes) or old_hashes[page] != page_hashes[page]
+            ]
+            stats["changed_pages"] = changed_pages
+            if not changed_pages:
+                await conn.execute(
+                    "UPDATE document SET content_hash = $1 WHERE id = $2", content_hash, uuid.UUID(job["document_id"])
+                )
+                update_job(job, status="completed", progress=1.0, stats={**stats, "reused_chunks": len(chunks), "embedded_chunks": 0})
+                return
+            rows = await conn.fetch(
+                "SELECT content, embedding FROM document_chunks WHERE document_id = $1", uuid.UUID(job["document_id"])
+            )
+            reusable = {row['content']: row['embedding'] for row in rows}
+
+    # 3. Embed only chunks whose text is new; unchanged pages yield identical chunks
+    update_job(job, status="embedding", progress=0.3)
+    new_chunks = list(dict.fromkeys(chunk for chunk in chunks if chunk not in reusable))
+    new_embeddings = await embed_with_progress(job, new_chunks, 0.3, 0.9)
+    reusable.update(zip(new_chunks, new_embeddings))
+    chunk_embeddings = np.vstack([reusable[chunk] for chunk in chunks]).astype(np.float32)
+    stats["embedded_chunks"] = len(new_chunks)
+    stats["reused_chunks"] = len(chunks) - len(new_chunks)
+
+    # 4. Write; the pool connection is held only for the write itself
+    update_job(job, status="saving", progress=0.9)
+    async with db_connection() as conn:
+        if job["mode"] == "update":
+            doc_id = uuid.UUID(job["document_id"])
+            await replace_document(conn, doc_id, job["user_id"], chunks, chunk_embeddings, page_count, content_hash, page_hashes)
+        else:
+            if await title_taken(conn, job["user_id"], job["filename"]):
+                update_job(job, status="failed", error="A file with this name already exists")
+                return
+            doc_id = await save_document(conn, job["user_id"], job["filename"], chunks, chunk_embeddings, page_count, content_hash, page_hashes)
+        await invalidate_caches(conn, job["user_id"], doc_id if job["mode"] == "update" else None)
+
+    update_job(job, status="completed", progress=1.0, document_id=str(doc_id), stats=stats)
+
+# Multi-file uploads: parse, embed and insert run as overlapping stages
+# joined by bounded queues. Each file keeps its own job for status.
+batch_pipelines: set = set()
+
+async def run_batch_pipeline(items: List[Tuple[dict, str, str]]) -> None:
+    """
+    Process `(job, path, content_hash)` items. Parsers feed a cross-file
+    embedding stage, which feeds a bulk-insert stage; a file that fails only
+    fails its own job.
+    """
+    pending: asyncio.Queue = asyncio.Queue()
+    for item in items:
+        pending.put_nowait(item)
+    embed_queue: asyncio.Queue = asyncio.Queue(maxsize=BATCH_STAGE_QUEUE_SIZE)
+    save_queue: asyncio.Queue = asyncio.Queue(maxsize=BATCH_STAGE_QUEUE_SIZE)
+
+    async def parse_stage() -> None:
+        while True:
+            try:
+                job, path, content_hash = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                if await clone_identical(job, content_hash):
+                    continue
+                parsed = await parse_upload(job, path)
+                if parsed:
+                    update_job(job, status="embedding", progress=0.3)
+                    await embed_queue.put((job, content_hash, parsed))
+            except Exception as e:
+                logger.exception("Batch job %s failed while parsing: %s", job["job_id"], e)
+                update_job(job, status="failed", error=str(e))
+            finally:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    async def take(queue: asyncio.Queue, limit: int, size) -> Tuple[list, bool]:
+        """
+        Block for one item, then take whatever else is ready up to `limit`
+        (measured with `size`). Returns the items and whether the stage ended.
+        """
+        group = []
+        total = 0
+        while True:
+            item = await queue.get() if not group else queue.get_nowait()
+            if item is None:
+                return group, True
+            group.append(item)
+            total += size(item)
+            if total >= limit or queue.empty():
+                return group, False
+
+    async def embed_stage() -> None:
+        finished = False
+        while not finished:
+            group, finished = await take(embed_queue, BATCH_EMBED_CHUNKS, lambda item: len(item[2]["chunks"]))
+            if not group:
+                continue
+            texts = [chunk for _, _, parsed in group for chunk in parsed["chunks"]]
+            try:
+                await embedder_ready.wait()
+                with timed("embedding"):
+                    vectors = await asyncio.to_thread(embed_chunks, texts)
+            except Exception as e:
+                for job, _, _ in group:
+                    update_job(job, status="failed", error=f"Embedding failed: {str(e)}")
+                continue
+            offset = 0
+            for job, content_hash, parsed in group:
+                count = len(parsed["chunks"])
+                update_job(job, status="saving", progress=0.9)
+                await save_queue.put((job, content_hash, parsed, vectors[offset:offset + count]))
+                offset += count
+        await save_queue.put(None)
+
+    async def save_stage() -> None:
+        finished = False
+        while not finished:
+            group, finished = await take(save_queue, BATCH_INSERT_DOCUMENTS, lambda item: 1)
+            if group:
+                await save_documents(group)
+
+    parsers = [asyncio.create_task(parse_stage()) for _ in range(min(INGEST_PROCESSES, len(items)))]
+    embedding = asyncio.create_task(embed_stage())
+    saving = asyncio.create_task(save_stage())
+    try:
+        await asyncio.gather(*parsers)
+        await embed_queue.put(None)
+        await asyncio.gather(embedding, saving)
+    except asyncio.CancelledError:
+        for task in (*parsers, embedding, saving):
+            task.cancel()
+        for job, path, _ in items:
+            if job["status"] not in ("completed", "failed"):
+                update_job(job, status="failed", error="Server shut down before the file was processed")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+
+async def save_documents(group: List[Tuple[dict, str, dict, np.ndarray]]) -> None:
+    """
+    Insert several parsed documents in one transaction: one executemany for
+    the documents and one COPY for all their chunks. If the bulk write fails,
+    fall back to saving one document at a time so a bad file only fails itself.
+    """
+    user_ids = {job["user_id"] for job, _, _, _ in group}
+    try:
+        async with db_connection() as conn:
+            taken = {
+                (str(row['user_id']), row['title'])
+                for row in await conn.fetch(
+                    "SELECT user_id, title FROM document WHERE user_id = ANY($1::uuid[]) AND title = ANY($2::text[])",
+                    [uuid.UUID(user_id) for user_id in user_ids], [job["filename"] for job, _, _, _ in group]
+                )
+            }
+            documents = []
+            chunk_records = []
+            saved = []
+            created_at = datetime.utcnow()
+            for job, content_hash, parsed, vectors in group:
+                if (job["user_id"], job["filename"]) in taken:
+                    update_job(job, status="failed", error="A file with this name already exists")
+                    continue
+                taken.add((job["user_id"], job["filename"]))
+                doc_id = uuid.uuid4()
+                chunks = parsed["chunks"]
+                content = "\n".join(chunks)
+                documents.append((
+                    doc_id, uuid.UUID(job["user_id"]), job["filename"], content, document_embedding(vectors), created_at,
+                    parsed["page_count"], len(chunks), len(content), content_hash, parsed["page_hashes"]
+                ))
+                chunk_records.extend(
+                    (uuid.uuid4(), doc_id, uuid.UUID(job["user_id"]), index, chunk, vector)
+                    for index, (chunk, vector) in enumerate(zip(chunks, vectors))
+                )
+                saved.append((job, doc_id, parsed["stats"]))
+            if documents:
+                async with conn.transaction():
+                    await conn.executemany(
+                        "INSERT INTO document(id, user_id, title, content, embedding, created_at, page_count, chunk_count, char_count, content_hash, page_hashes) "
+                        "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)",
+                        documents
+                    )
+                    await conn.copy_records_to_table(
+                        "document_chunks",
+                        columns=["chunk_id", "document_id", "user_id", "chunk_index", "content", "embedding"],
+                        records=chunk_records
+                    )
+                for job, doc_id, stats in saved:
+                    update_job(job, status="completed", progress=1.0, document_id=str(doc_id), stats=stats)
+                for user_id in {job["user_id"] for job, _, _ in saved}:
+                    await invalidate_caches(conn, user_id)
+    except Exception as e:
+        logger.warning("Bulk insert of %d documents failed (%s); saving them one at a time", len(group), e)
+        for job, content_hash, parsed, vectors in group:
+            if job["status"] != "saving":
+                continue
+            try:
+                async with db_connection() as conn:
+                    if await title_taken(conn, job["user_id"], job["filename"]):
+                        update_job(job, status="failed", error="A file with this name already exists")
+                        continue
+                    doc_id = await save_document(
+                        conn, job["user_id"], job["filename"], parsed["chunks"], vectors,
+                        parsed["page_count"], content_hash, parsed["page_hashes"]
+                    )
+                    await invalidate_caches(conn, job["user_id"])
+                update_job(job, status="completed", progress=1.0, document_id=str(doc_id), stats=parsed["stats"])
+            except Exception as save_error:
+                logger.exception("Saving batch job %s failed: %s", job["job_id"], save_error)
+                update_job(job, status="failed", error=str(save_error))
+
+async def title_taken(conn: asyncpg.Connection, user_id: str, title: str) -> bool:
+    existing_document = await conn.fetchrow(
+        "SELECT id FROM document WHERE user_id = $1 AND title = $2",
+        uuid.UUID(user_id), title
+    )
+    return existing_document is not None
+
+async def insert_chunks(conn: asyncpg.Connection, doc_id: uuid.UUID, user_id: str, chunks: List[str], chunk_embeddings: np.ndarray) -> None:
+    await conn.executemany(
+        "INSERT INTO document_chunks(chunk_id, document_id, user_id, chunk_index, content, embedding) "
+        "VALUES ($1, $2, $3, $4, $5, $6)",
+        [
+            (uuid.uuid4(), doc_id, uuid.UUID(user_id), index, chunk, vector)
+            for index, (chunk, vector) in enumerate(zip(chunks, chunk_embeddings))
+        ]
+    )
+
+async def save_document(conn: asyncpg.Connection, user_id: str, title: str, chunks: List[str], chunk_embeddings: np.ndarray,
+                        page_count: int, content_hash: str, page_hashes: List[str]) -> uuid.UUID:
+    content = "\n".join(chunks)
+    embedding = document_embedding(chunk_embeddings)
+    doc_id = uuid.uuid4()
+    async with conn.transaction():
+        await conn.execute(
+            "INSERT INTO document(id, user_id, title, content, embedding, created_at, page_count, chunk_count, char_count, content_hash, page_hashes) "
+            "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)",
+            doc_id, uuid.UUID(user_id), title, content,
+            embedding, datetime.utcnow(), page_count, len(chunks), len(content), content_hash, page_hashes
+        )
+        await insert_chunks(conn, doc_id, user_id, chunks, chunk_embeddings)
+    return doc_id
+
+async def replace_document(conn: asyncpg.Connection, doc_id: uuid.UUID, user_id: str, chunks: List[str], chunk_embeddings: np.ndarray,
+                           page_count: int, content_hash: str, page_hashes: List[str]) -> None:
+    """
+    Swap in new content and chunks while keeping the document id, so its
+    flashcards and query history survive the update.
+    """
+    content = "\n".join(chunks)
+    async with conn.transaction():
+        await conn.execute(
+            "UPDATE document SET content = $1, embedding = $2, page_count = $3, chunk_count = $4, char_count = $5, "
+            "content_hash = $6, page_hashes = $7 WHERE id = $8",
+            content, document_embedding(chunk_embeddings), page_count, len(chunks), len(content),
+            content_hash, page_hashes, doc_id
+        )
+        await conn.execute("DELETE FROM document_chunks WHERE document_id = $1", doc_id)
+        await insert_chunks(conn, doc_id, user_id, chunks, chunk_embeddings)
+
+async def clone_document(conn: asyncpg.Connection, source_id: uuid.UUID, user_id: str, title: str) -> Tuple[uuid.UUID, dict]:
+    """
+    Copy an already-ingested document, chunks and embeddings included, for another upload of the same file.
+    """
+    doc_id = uuid.uuid4()
+    async with conn.transaction():
+        stats = await conn.fetchrow(
+            "INSERT INTO document(id, user_id, title, content, embedding, created_at, page_count, chunk_count, char_count, content_hash, page_hashes) "
+            "SELECT $1, $2, $3, content, embedding, $4, page_count, chunk_count, char_count, content_hash, page_hashes "
+            "FROM document WHERE id = $5 "
+            "RETURNING page_count, chunk_count, char_count",
+            doc_id, uuid.UUID(user_id), title, datetime.utcnow(), source_id
+        )
+        await conn.execute(
+            "INSERT INTO document_chunks(chunk_id, document_id, user_id, chunk_index, content, embedding) "
+            "SELECT gen_random_uuid(), $1, $2, chunk_index, content, embedding FROM document_chunks WHERE document_id = $3",
+            doc_id, uuid.UUID(user_id), source_id
+        )
+    return doc_id, {"pages": stats['page_count'], "chunks": stats['chunk_count'], "total_characters": stats['char_count']}
+
+# Advisory lock key so only one process per database runs the chunk backfill
+CHUNK_BACKFILL_LOCK = 0x496E7131
+
+async def backfill_document_chunks() -> None:
+    """
+    Index chunks for documents stored before per-chunk retrieval existed.
+    Their content holds the chunks newline-separated, as load_document_chunks
+    reads them. A document is only written if it still has no chunks, so a
+    concurrent update or a rerun never duplicates them.
+    """
+    await embedder_ready.wait()
+    lock_conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if not await lock_conn.fetchval("SELECT pg_try_advisory_lock($1)", CHUNK_BACKFILL_LOCK):
+            return
+        after = uuid.UUID(int=0)
+        indexed = 0
+        while True:
+            async with db_connection() as conn:
+                rows = await conn.fetch(
+                    "SELECT id, user_id, content FROM document d "
+                    "WHERE id > $1 AND content IS NOT NULL "
+                    "AND NOT EXISTS (SELECT 1 FROM document_chunks c WHERE c.document_id = d.id) "
+                    "ORDER BY id LIMIT $2",
+                    after, CHUNK_BACKFILL_BATCH
+                )
+            if not rows:
+                break
+            after = rows[-1]['id']
+            for row in rows:
+                chunks = [text for text in row['content'].split("\n") if text.strip()]
+                if not chunks:
+                    continue
+                with timed("embedding"):
+                    vectors = await asyncio.to_thread(embed_chunks, chunks)
+                user_id = str(row['user_id'])
+                async with db_connection() as conn:
+                    async with conn.transaction():
+                        # The row lock orders this against replace_document on the same document
+                        await conn.execute("SELECT 1 FROM document WHERE id = $1 FOR UPDATE", row['id'])
+                        if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM document_chunks WHERE document_id = $1)", row['id']):
+                            continue
+                        await insert_chunks(conn, row['id'], user_id, chunks, vectors)
+                        await conn.execute("UPDATE document SET chunk_count = $1 WHERE id = $2", len(chunks), row['id'])
+                    await invalidate_caches(conn, user_id, row['id'])
+                indexed += 1
+        if indexed:
+            logger.info("Backfilled chunks for %d documents", indexed)
+    except Exception as e:
+        logger.exception("Chunk backfill failed: %s", e)
+    finally:
+        await lock_conn.close()
+
+def spool_upload(file: UploadFile) -> Tuple[str, str]:
+    """
+    Copy the upload to a temporary file, hashing it on the way. Returns the path and SHA-256.
+    """
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(prefix="inquiro-", suffix=".pdf", delete=False) as spooled:
+        file.file.seek(0)
+        while True:
+            block = file.file.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+            spooled.write(block)
+        return spooled.name, digest.hexdigest()
+
+def job_response(job: dict) -> dict:
+    return {
+        "job_id": job["job_id"],
+        "filename": job["filename"],
+        "status": job["status"],
+        "progress": round(job["progress"], 3),
+        "document_id": job["document_id"],
+        "stats": job["stats"],
+        "error": job["error"],
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat(),
+    }
+
+@app.post("/upload", status_code=status.HTTP_202_ACCEPTED)
+async def upload_document(file: UploadFile = File(...), user_id: str = Depends(get_current_user)):
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not initialized")
+    if not ingestion_queue:
+        raise HTTPException(status_code=500, detail="Ingestion pipeline not initialized")
+    
+    # Check if filename exists and is a PDF
+    if not file.filename or not file.filename.endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Only PDF files can be uploaded")
+    
+    try:
+        async with db_connection() as conn:
+            existing_document = await conn.fetchrow(
+                "SELECT id FROM document WHERE user_id = $1 AND title = $2",
+                uuid.UUID(user_id), file.filename
+            )
+        if existing_document or job_pending(user_id, file.filename):
+            raise HTTPException(status_code=400, detail="A file with this name already exists")
+
+        job = await enqueue_upload(file, user_id, file.filename)
+        return {
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "message": f"Upload of {file.filename} queued for processing."
+        }
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.exception("Unexpected error during upload: %s", e)
+        raise HTTPException(status_code=500, detail=f"Unexpected error during upload: {str(e)}")
+
+@app.post("/upload/batch", status_code=status.HTTP_202_ACCEPTED)
+async def upload_documents(files: List[UploadFile] = File(...), user_id: str = Depends(get_current_user)):
+    """
+    Queue many PDFs at once. Every accepted file gets its own job to poll at
+    /jobs/{job_id}; files rejected up front are reported in the response.
+    """
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not initialized")
+    if not ingestion_executor:
+        raise HTTPException(status_code=500, detail="Ingestion pipeline not initialized")
+    if len(files) > BATCH_UPLOAD_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_UPLOAD_MAX_FILES} files can be uploaded at once")
+    if len(batch_pipelines) >= BATCH_MAX_ACTIVE:
+        raise HTTPException(status_code=503, detail="Too many batch uploads in progress, please retry shortly")
+
+    items = []
+    try:
+        async with db_connection() as conn:
+            existing = {
+                row['title'] for row in await conn.fetch(
+                    "SELECT title FROM document WHERE user_id = $1 AND title = ANY($2::text[])",
+                    uuid.UUID(user_id), [file.filename for file in files if file.filename]
+                )
+            }
+
+        results = []
+        for file in files:
+            if not file.filename or not file.filename.endswith('.pdf'):
+                results.append({"filename": file.filename, "status": "rejected", "error": "Only PDF files can be uploaded"})
+                continue
+            if file.filename in existing or job_pending(user_id, file.filename):
+                results.append({"filename": file.filename, "status": "rejected", "error": "A file with this name already exists"})
+                continue
+            existing.add(file.filename)
+            path, content_hash = await asyncio.to_thread(spool_upload, file)
+            job = create_job(user_id, file.filename)
+            items.append((job, path, content_hash))
+            results.append({"filename": file.filename, "status": job["status"], "job_id": job["job_id"]})
+
+        if items:
+            await job_mirror.publish([job for job, _, _ in items])
+            task = asyncio.create_task(run_batch_pipeline(items))
+            batch_pipelines.add(task)
+            task.add_done_callback(batch_pipelines.discard)
+        return {
+            "accepted": len(items),
+            "rejected": len(results) - len(items),
+            "files": results,
+            "message": f"{len(items)} of {len(files)} files queued for processing."
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        for job, path, _ in items:
+            ingestion_jobs.pop(job["job_id"], None)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        logger.exception("Unexpected error during batch upload: %s", e)
+        raise HTTPException(status_code=500, detail=f"Unexpected error during batch upload: {str(e)}")
+
+@app.put("/documents/{document_id}", status_code=status.HTTP_202_ACCEPTED)
+async def update_document(document_id: str, file: UploadFile = File(...), user_id: str = Depends(get_current_user)):
+    """
+    Replace a document's PDF in place. Only chunks from changed pages are
+    re-embedded, and the document keeps its id, flashcards and query history.
+    """
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not initialized")
+    if not ingestion_queue:
+        raise HTTPException(status_code=500, detail="Ingestion pipeline not initialized")
+
+    if not file.filename or not file.filename.endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Only PDF files can be uploaded")
+
+    try:
+        async with db_connection() as conn:
+            existing_doc = await conn.fetchrow(
+                "SELECT title FROM document WHERE id = $1 AND user_id = $2",
+                uuid.UUID(document_id), uuid.UUID(user_id)
+            )
+        if not existing_doc:
+            raise HTTPException(status_code=404, detail="Document not found")
+        if any(job["document_id"] == document_id and job["status"] not in ("completed", "failed") for job in ingestion_jobs.values()):
+            raise HTTPException(status_code=409, detail="An update for this document is already in progress")
+
+        job = await enqueue_upload(file, user_id, existing_doc['title'], document_id)
+        return {
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "message": f"Update of {existing_doc['title']} queued for processing."
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Unexpected error during document update: %s", e)
+        raise HTTPException(status_code=500, detail=f"Unexpected error during document update: {str(e)}")
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, user_id: str = Depends(get_current_user)):
+    job = ingestion_jobs.get(job_id)
+    if job and job["user_id"] == user_id:
+        return job_response(job)
+    # The upload may have landed on another worker
+    state = await job_mirror.fetch(job_id, user_id) if not job else None
+    if not state:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return state
+
+@app.post("/query")
+async def query_document(query: QueryRequest, user_id: str = Depends(get_current_user)):
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not initialized")
+    
+    try:
+        with timed("query_embedding"):
+            query_vector = await query_batcher.encode(query.question)
+
+        # 1. Fetch the most similar passages across the user's documents; a
+        #    pool connection is held for this lookup only, never across the LLM call
+        with timed("retrieval"):
+            rows = await search_chunks(user_id, query_vector)
+        rows, context_tokens = build_context(rows, QUERY_CONTEXT_TOKENS)
+        sources = group_passages(rows)
+        source_ids = [row['chunk_id'] for row in rows]
+
+        # 2. Serve a cached answer for a near-identical question over the same passages
+        answer = answer_cache.lookup(user_id, query_vector, source_ids)
+        cached = answer is not None
+
+        # 3. Otherwise prepare the prompt and ask Gemini
+        if not cached:
+            prompt = build_query_prompt(query.question, sources)
+            started = time.perf_counter()
+            answer = await llm_gateway.generate(prompt)
+            answer_cache.store(
+                user_id, query_vector, source_ids, [src['id'] for src in sources],
+                answer, (time.perf_counter() - started) * 1000
+            )
+
+        # 4. Queue the query log write; it is flushed in the background
+        query_id = uuid.uuid4()
+        document_id = rows[0]['id'] if rows else None
+        if document_id:
+            query_log.enqueue(query_id, user_id, document_id, query.question, answer)
+
+        # 5. Return result
+        documents = source_documents(sources)
         return {
             "query_id": str(query_id),
-            "answer": response.text,
+            "answer": answer,
             "documents": documents,
-            "context_available": len(documents) > 0
+            "context_available": len(documents) > 0,
+            "context_tokens": context_tokens,
+            "cached": cached
         }
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to process query: {str(e)}")
+
+@app.post("/query/stream")
+async def query_document_stream(query: QueryRequest, user_id: str = Depends(get_current_user)):
+    """
+    Server-sent events variant of /query. Tokens are forwarded as Gemini
+    produces them; the pool connection is only held for retrieval, and the
+    query log is queued once the stream finishes.
+    """
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not initialized")
+
+    try:
+        with timed("query_embedding"):
+            query_vector = await query_batcher.encode(query.question)
+        with timed("retrieval"):
+            rows = await search_chunks(user_id, query_vector)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to process query: {str(e)}")
 
+    rows, context_tokens = build_context(rows, QUERY_CONTEXT_TOKENS)
+    sources = group_passages(rows)
+    source_ids = [row['chunk_id'] for row in rows]
+    documents = source_documents(sources)
+    cached_answer = answer_cache.lookup(user_id, query_vector, source_ids)
+    if cached_answer is None:
+        llm_gateway.admit()  # a full queue is a plain 429, before the stream starts
+
+    async def event_stream():
+        if cached_answer is not None:
+            answer = cached_answer
+            yield sse_event({"type": "token", "text": answer})
+        else:
+            parts = []
+            started = time.perf_counter()
+            first_token_ms = None
+            try:
+                async for text in llm_gateway.stream(build_query_prompt(query.question, sources)):
+                    if first_token_ms is None:
+                        first_token_ms = (time.perf_counter() - started) * 1000
+                        record_stage("llm_first_token", first_token_ms / 1000)
+                    parts.append(text)
+                    yield sse_event({"type": "token", "text": text})
+            except Exception as e:
+                logger.exception("Error streaming query response: %s", e)
+                yield sse_event({"type": "error", "detail": f"Failed to process query: {str(e)}"})
+                return
+            answer = "".join(parts)
+            llm_ms = (time.perf_counter() - started) * 1000
+            logger.info("Streamed answer: first token %.0f ms, total %.0f ms", first_token_ms or llm_ms, llm_ms)
+            answer_cache.store(user_id, query_vector, source_ids, [src['id'] for src in sources], answer, llm_ms)
+
+        query_id = uuid.uuid4()
+        if rows:
+            query_log.enqueue(query_id, user_id, rows[0]['id'], query.question, answer)
+
+        yield sse_event({
+            "type": "done",
+            "query_id": str(query_id),
+            "documents": documents,
+            "context_available": len(documents) > 0,
+            "context_tokens": context_tokens,
+            "cached": cached_answer is not None
+        })
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def encode_cursor(created_at: datetime, document_id: uuid.UUID) -> str:
+    raw = f"{created_at.isoformat()}|{document_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    try:
+        created_at, document_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(document_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @app.get("/documents")
-async def get_user_documents(user_id: str = Depends(get_current_user)):
+async def get_user_documents(
+    request: Request,
+    response: Response,
+    limit: int = Query(DOCUMENTS_PAGE_SIZE, ge=1, le=200),
+    cursor: Optional[str] = None,
+    user_id: str = Depends(get_current_user)
+):
+    """
+    Keyset-paginated listing, newest first. The cursor for the next page is
+    returned in the X-Next-Cursor header; the body stays a plain list.
+    """
     if not pool:
         raise HTTPException(status_code=500, detail="Database connection not initialized")
     
+    after = decode_cursor(cursor) if cursor else None
     try:
-        async with pool.acquire() as conn:
-            documents = await conn.fetch(
-                """
-                SELECT id, title, created_at, content
-                FROM document 
-                WHERE user_id = $1 
-                ORDER BY created_at DESC
-                """,
-                uuid.UUID(user_id)
-            )
-            
-            result = []
-            for doc in documents:
-                # Calculate stats
-                content_length = len(doc['content']) if doc['content'] else 0
-                
-                result.append({
-                    "id": str(doc['id']),
-                    "title": doc['title'],
-                    "created_at": doc['created_at'].isoformat(),
-                    "stats": {
-                        "total_characters": content_length,
-                        "pages": max(1, content_length // 2000),  # Estimate pages
-                        "chunks": max(1, content_length // 500)   # Estimate chunks
-                    }
-                })
-            
-            return result
-            
+        async with db_connection() as conn:
+            if after:
+                documents = await conn.fetch(
+                    """
+                    SELECT id, title, created_at, page_count, chunk_count, char_count
+                    FROM document
+                    WHERE user_id = $1 AND (created_at, id) < ($2, $3)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT $4
+                    """,
+                    uuid.UUID(user_id), after[0], after[1], limit + 1
+                )
+            else:
+                documents = await conn.fetch(
+                    """
+                    SELECT id, title, created_at, page_count, chunk_count, char_count
+                    FROM document
+                    WHERE user_id = $1
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT $2
+                    """,
+                    uuid.UUID(user_id), limit + 1
+                )
     except Exception as e:
-        print(f"Error fetching documents: {str(e)}")
+        logger.exception("Error fetching documents: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch documents")
 
+    has_more = len(documents) > limit
+    documents = documents[:limit]
+    result = [
+        {
+            "id": str(doc['id']),
+            "title": doc['title'],
+            "created_at": doc['created_at'].isoformat(),
+            "stats": {
+                "total_characters": doc['char_count'] or 0,
+                "pages": doc['page_count'] or 0,
+                "chunks": doc['chunk_count'] or 0
+            }
+        }
+        for doc in documents
+    ]
+
+    headers = {"Cache-Control": "private, no-cache"}
+    if has_more:
+        last = documents[-1]
+        headers["X-Next-Cursor"] = encode_cursor(last['created_at'], last['id'])
+    body = json.dumps(result)
+    headers["ETag"] = 'W/"' + hashlib.sha1(body.encode("utf-8") + headers.get("X-Next-Cursor", "").encode("ascii")).hexdigest() + '"'
+
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.delete("/documents/{document_id}")
 async def delete_document(document_id: str, user_id: str = Depends(get_current_user)):
     if not pool:
         raise HTTPException(status_code=500, detail="Database connection not initialized")
     
     try:
-        async with pool.acquire() as conn:
+        async with db_connection() as conn:
             # Check if document exists and belongs to user
             existing_doc = await conn.fetchrow(
                 "SELECT id FROM document WHERE id = $1 AND user_id = $2",
@@ -489,103 +2989,332 @@ async def delete_document(document_id: str, user_id: str = Depends(get_current_u
                 uuid.UUID(document_id),
                 uuid.UUID(user_id)
             )
+            await invalidate_caches(conn, user_id, uuid.UUID(document_id))
             
             return {"message": "Document deleted successfully"}
             
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error deleting document: {str(e)}")
+        logger.exception("Error deleting document: %s", e)
         raise HTTPException(status_code=500, detail="Failed to delete document")
     
 
+def build_flashcard_prompt(num_flashcards: int, content: str) -> str:
+    return (
+        f"You are an expert in creating educational flashcards. Given the following document content, "
+        f"generate exactly {num_flashcards} flashcard question-answer pairs. Each flashcard should have a 'question' and 'answer' field. "
+        "Focus on key concepts, definitions, processes, or facts suitable for studying. Ensure questions are clear, concise, and varied (e.g., definitions, processes, examples). "
+        "If insufficient content exists to generate the requested number, generate as many as possible and note the limitation in the response. "
+        "Return a JSON array of objects with 'question' and 'answer' fields."
+        f"\n\nDocument Content:\n{content}"
+    )
+
+def parse_flashcards(response_text: str) -> List[dict]:
+    response_text = response_text.strip()
+    if response_text.startswith("```json"):
+        response_text = response_text[7:]
+    if response_text.endswith("```"):
+        response_text = response_text[:-3]
+
+    flashcards = json.loads(response_text.strip())
+    if not isinstance(flashcards, list):
+        raise ValueError("Expected a list of flashcards")
+    return flashcards
+
+async def load_document_chunks(conn: asyncpg.Connection, document_id: str, content: str) -> List[dict]:
+    rows = await conn.fetch(DOCUMENT_CHUNKS_SQL, uuid.UUID(document_id))
+    if rows:
+        return [{"content": row['content'], "chunk_index": row['chunk_index']} for row in rows]
+    # Documents uploaded before chunk indexing store their chunks newline-separated
+    return [
+        {"content": text, "chunk_index": index}
+        for index, text in enumerate(content.split("\n")) if text.strip()
+    ]
+
+async def save_flashcards(conn: asyncpg.Connection, user_id: str, document_id: str, cards: List[dict]) -> None:
+    """
+    Persist cards that already carry a flashcard_id and created_at with a single COPY.
+    """
+    await conn.copy_records_to_table(
+        "flashcards",
+        columns=["flashcard_id", "user_id", "document_id", "question", "answer", "created_at"],
+        records=[
+            (uuid.UUID(card['flashcard_id']), uuid.UUID(user_id), uuid.UUID(document_id),
+             card['question'], card['answer'], card['created_at'])
+            for card in cards
+        ]
+    )
+
+def split_sections(chunks: List[dict], section_tokens: int, max_sections: Optional[int] = None) -> List[List[dict]]:
+    """
+    Group consecutive chunks into sections of roughly `section_tokens` each,
+    widening them when needed so there are at most `max_sections`.
+    """
+    if max_sections:
+        total_tokens = sum(estimate_tokens(chunk["content"]) for chunk in chunks)
+        section_tokens = max(section_tokens, -(-total_tokens // max_sections))
+    sections = [[]]
+    used = 0
+    for chunk in chunks:
+        cost = estimate_tokens(chunk["content"])
+        if sections[-1] and used + cost > section_tokens:
+            sections.append([])
+            used = 0
+        sections[-1].append(chunk)
+        used += cost
+    sections = [section for section in sections if section]
+    while max_sections and len(sections) > max_sections:
+        sections[-2].extend(sections.pop())
+    return sections
+
+def allocate_cards(total: int, weights: List[int]) -> List[int]:
+    """
+    Split `total` cards across sections in proportion to `weights` (largest remainder).
+    """
+    shares = [total * weight / sum(weights) for weight in weights]
+    counts = [int(share) for share in shares]
+    by_remainder = sorted(range(len(shares)), key=lambda i: counts[i] - shares[i])
+    for i in by_remainder[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+# Section outputs keyed by a digest of the section text and card count
+flashcard_section_cache: "OrderedDict[str, List[dict]]" = OrderedDict()
+
+async def generate_section_flashcards(section_text: str, num_cards: int, semaphore: asyncio.Semaphore) -> Tuple[List[dict], bool]:
+    """
+    Cards for one section, from the section cache or from Gemini with retries.
+    Returns the cards and whether they came from the cache.
+    """
+    key = hashlib.sha256(f"{num_cards}\n{section_text}".encode("utf-8")).hexdigest()
+    if key in flashcard_section_cache:
+        flashcard_section_cache.move_to_end(key)
+        metrics.inc("inquiro_cache_requests_total", {"cache": "flashcard_section", "result": "hit"})
+        return flashcard_section_cache[key], True
+    metrics.inc("inquiro_cache_requests_total", {"cache": "flashcard_section", "result": "miss"})
+
+    prompt = build_flashcard_prompt(num_cards, section_text)
+    async with semaphore:
+        for attempt in range(FLASHCARD_MAX_RETRIES + 1):
+            try:
+                cards = [
+                    {"question": card['question'], "answer": card['answer']}
+                    for card in parse_flashcards(await llm_gateway.generate(prompt))
+                ]
+                break
+            except LLMBusyError:
+                raise
+            except Exception as e:
+                if attempt == FLASHCARD_MAX_RETRIES:
+                    raise
+                delay = FLASHCARD_RETRY_BASE_SECONDS * (2 ** attempt)
+                logger.warning("Flashcard section attempt %d failed (%s), retrying in %.1fs", attempt + 1, e, delay)
+                await asyncio.sleep(delay)
+
+    flashcard_section_cache[key] = cards
+    while len(flashcard_section_cache) > FLASHCARD_SECTION_CACHE_SIZE:
+        flashcard_section_cache.popitem(last=False)
+    return cards, False
+
+async def create_flashcards(id: str, num_flashcards: int, user_id: str) -> dict:
+    # Connections are taken for the reads and the write, not across the Gemini call
+    async with db_connection() as conn:
+        document = await conn.fetchrow(DOCUMENT_LOOKUP_SQL, uuid.UUID(id), uuid.UUID(user_id))
+        if not document:
+            raise HTTPException(status_code=404, detail="Document not found or not owned by user")
+
+        if not document['content']:
+            raise HTTPException(status_code=400, detail="No content available for this document")
+
+        chunks = await load_document_chunks(conn, id, document['content'])
+    if not chunks:
+        raise HTTPException(status_code=400, detail="No sentences available to generate flashcards")
+
+    # Sample passages evenly across the whole document, then restore reading order
+    selected, context_tokens = build_context(
+        [chunks[i] for i in coverage_order(len(chunks))], FLASHCARD_CONTEXT_TOKENS
+    )
+    selected.sort(key=lambda chunk: chunk["chunk_index"])
+    content_to_process = "\n".join(chunk["content"] for chunk in selected)
+    logger.info("Flashcard context: %d/%d chunks, ~%d tokens", len(selected), len(chunks), context_tokens)
+    prompt = build_flashcard_prompt(num_flashcards, content_to_process)
+    flashcards = parse_flashcards(await llm_gateway.generate(prompt))
+
+    created_at = datetime.utcnow()
+    flashcards = [
+        {
+            "flashcard_id": str(uuid.uuid4()),
+            "question": card['question'],
+            "answer": card['answer'],
+            "created_at": created_at
+        }
+        for card in flashcards
+    ]
+    async with db_connection() as conn:
+        async with conn.transaction():
+            await save_flashcards(conn, user_id, id, flashcards)
+
+    message = f"Generated {len(flashcards)} flashcards for {document['title']}"
+    if len(flashcards) < num_flashcards:
+        message += f". Requested {num_flashcards}, but only {len(flashcards)} could be generated due to limited content."
+
+    return {
+        "id": id,
+        "flashcards": [{**card, "created_at": card["created_at"].isoformat()} for card in flashcards],
+        "message": message,
+        "context_tokens": context_tokens
+    }
+
 @app.post("/flashcards/{id}")
 async def generate_flashcards(id: str, request: FlashcardRequest, user_id: str = Depends(get_current_user)):
     if not pool:
         raise HTTPException(status_code=500, detail="Database connection not initialized")
     
     try:
-        print(f"Received request: {request}")  # Debug log
+        logger.debug("Received request: %s", request)
         num_flashcards = min(max(request.num_flashcards, 1), 20)  # Cap between 1 and 20
-        async with pool.acquire() as conn:
-            document = await conn.fetchrow(
-                "SELECT content, title FROM document WHERE id = $1 AND user_id = $2",
-                uuid.UUID(id), uuid.UUID(user_id)
-            )
+        # A repeated click while the first generation runs gets the same cards, saved once
+        return await llm_gateway.coalesce(
+            ("flashcards", user_id, id, num_flashcards), lambda: create_flashcards(id, num_flashcards, user_id)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error generating flashcards: %s", e)
+        raise HTTPException(status_code=500, detail=f"Failed to generate flashcards: {str(e)}")
+
+@app.post("/flashcards/{id}/stream")
+async def generate_flashcards_stream(id: str, request: FlashcardRequest, user_id: str = Depends(get_current_user)):
+    """
+    Map-reduce flashcard generation over the whole document, streamed as
+    server-sent events. Sections are sent to Gemini concurrently (bounded by
+    FLASHCARD_CONCURRENCY), near-duplicate cards are dropped by embedding
+    similarity, and accepted cards are emitted in document order. There are
+    at most `num_flashcards` sections, and outstanding calls are cancelled
+    once the requested number of cards is reached.
+    """
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not initialized")
+
+    num_flashcards = min(max(request.num_flashcards, 1), 20)  # Cap between 1 and 20
+    try:
+        async with db_connection() as conn:
+            document = await conn.fetchrow(DOCUMENT_LOOKUP_SQL, uuid.UUID(id), uuid.UUID(user_id))
             if not document:
                 raise HTTPException(status_code=404, detail="Document not found or not owned by user")
-
             if not document['content']:
                 raise HTTPException(status_code=400, detail="No content available for this document")
-
-            chunks = nltk.sent_tokenize(document['content'])
-            if not chunks:
-                raise HTTPException(status_code=400, detail="No sentences available to generate flashcards")
-
-            content_to_process = "\n".join(chunks)[:16000]
-            prompt = (
-                f"You are an expert in creating educational flashcards. Given the following document content, "
-                f"generate exactly {num_flashcards} flashcard question-answer pairs. Each flashcard should have a 'question' and 'answer' field. "
-                "Focus on key concepts, definitions, processes, or facts suitable for studying. Ensure questions are clear, concise, and varied (e.g., definitions, processes, examples). "
-                "If insufficient content exists to generate the requested number, generate as many as possible and note the limitation in the response. "
-                "Return a JSON array of objects with 'question' and 'answer' fields."
-                f"\n\nDocument Content:\n{content_to_process}"
-            )
-            model = genai.GenerativeModel("gemini-1.5-flash")
-            response = model.generate_content(prompt)
-
-            response_text = response.text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            
-            flashcards = json.loads(response_text.strip())
-            if not isinstance(flashcards, list):
-                raise ValueError("Expected a list of flashcards")
-
-            flashcard_ids = []
-            for card in flashcards:
-                flashcard_id = uuid.uuid4()
-                await conn.execute(
-                    "INSERT INTO flashcards(flashcard_id, user_id, document_id, question, answer, created_at) "
-                    "VALUES ($1, $2, $3, $4, $5, $6)",
-                    flashcard_id, uuid.UUID(user_id), uuid.UUID(id), card['question'], card['answer'], datetime.utcnow()
-                )
-                flashcard_ids.append(str(flashcard_id))
-
-            message = f"Generated {len(flashcards)} flashcards for {document['title']}"
-            if len(flashcards) < num_flashcards:
-                message += f". Requested {num_flashcards}, but only {len(flashcards)} could be generated due to limited content."
-
-            return {
-                "id": id,
-                "flashcards": [
-                    {
-                        "flashcard_id": fid,
-                        "question": card['question'],
-                        "answer": card['answer'],
-                        "created_at": datetime.utcnow().isoformat()
-                    }
-                    for fid, card in zip(flashcard_ids, flashcards)
-                ],
-                "message": message
-            }
+            chunks = await load_document_chunks(conn, id, document['content'])
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error generating flashcards: {str(e)}")  # Debug log
         raise HTTPException(status_code=500, detail=f"Failed to generate flashcards: {str(e)}")
 
+    sections = split_sections(chunks, FLASHCARD_SECTION_TOKENS, max_sections=num_flashcards)
+    if not sections:
+        raise HTTPException(status_code=400, detail="No sentences available to generate flashcards")
+
+    # Share the requested cards across sections by size; each section is asked
+    # for one spare to absorb duplicates, and unfilled shares carry forward
+    section_texts = ["\n".join(chunk["content"] for chunk in section) for section in sections]
+    section_shares = allocate_cards(num_flashcards, [estimate_tokens(text) for text in section_texts])
+    section_counts = [max(1, share) + 1 for share in section_shares]
+    llm_gateway.admit()
+
+    async def event_stream():
+        semaphore = asyncio.Semaphore(FLASHCARD_CONCURRENCY)
+
+        async def run_section(index: int, text: str, count: int):
+            try:
+                return index, await generate_section_flashcards(text, count, semaphore), None
+            except Exception as e:
+                return index, ([], False), e
+
+        tasks = [
+            asyncio.create_task(run_section(index, text, count))
+            for index, (text, count) in enumerate(zip(section_texts, section_counts))
+        ]
+        accepted = []
+        accepted_vectors = None
+        owed = 0
+        try:
+            # Sections are taken in document order, so the kept cards do not
+            # depend on which Gemini call happens to finish first
+            for task in tasks:
+                index, (cards, cached), error = await task
+                allowance = section_shares[index] + owed
+                if error:
+                    logger.warning("Flashcard section %d failed: %s", index + 1, error)
+                    yield sse_event({"type": "section_error", "section": index, "detail": str(error)})
+                    owed = allowance
+                    continue
+
+                new_cards = []
+                if cards and allowance > 0:
+                    await embedder_ready.wait()
+                    vectors = await asyncio.to_thread(
+                        embed_chunks, [f"{card['question']} {card['answer']}" for card in cards]
+                    )
+                    for card, vector in zip(cards, vectors):
+                        if len(new_cards) >= allowance:
+                            break
+                        if accepted_vectors is not None and float(np.max(accepted_vectors @ vector)) >= FLASHCARD_DEDUP_THRESHOLD:
+                            continue
+                        accepted_vectors = vector[None, :] if accepted_vectors is None else np.vstack([accepted_vectors, vector])
+                        card = {
+                            "flashcard_id": str(uuid.uuid4()),
+                            "question": card['question'],
+                            "answer": card['answer'],
+                            "created_at": datetime.utcnow(),
+                        }
+                        accepted.append(card)
+                        new_cards.append(card)
+
+                owed = allowance - len(new_cards)
+
+                yield sse_event({
+                    "type": "section",
+                    "section": index,
+                    "sections": len(sections),
+                    "cached": cached,
+                    "flashcards": [{**card, "created_at": card["created_at"].isoformat()} for card in new_cards],
+                })
+                if len(accepted) >= num_flashcards:
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if accepted:
+            try:
+                async with db_connection() as conn:
+                    async with conn.transaction():
+                        await save_flashcards(conn, user_id, id, accepted)
+            except Exception as e:
+                logger.exception("Error saving flashcards: %s", e)
+                yield sse_event({"type": "error", "detail": f"Failed to save flashcards: {str(e)}"})
+                return
+
+        message = f"Generated {len(accepted)} flashcards for {document['title']} from {len(sections)} sections"
+        if len(accepted) < num_flashcards:
+            message += f". Requested {num_flashcards}, but only {len(accepted)} could be generated due to limited content."
+        yield sse_event({"type": "done", "id": id, "count": len(accepted), "message": message})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/flashcards/{id}", response_model=List[Flashcard])
 async def get_flashcards(id: str, user_id: str = Depends(get_current_user)):
     if not pool:
         raise HTTPException(status_code=500, detail="Database connection not initialized")
     
     try:
-        async with pool.acquire() as conn:
-            flashcards = await conn.fetch(
-                "SELECT flashcard_id, question, answer, created_at FROM flashcards WHERE document_id = $1 AND user_id = $2 ORDER BY created_at",
-                uuid.UUID(id), uuid.UUID(user_id)
-            )
+        async with db_connection() as conn:
+            flashcards = await conn.fetch(FLASHCARDS_SQL, uuid.UUID(id), uuid.UUID(user_id))
             if not flashcards:
                 raise HTTPException(status_code=404, detail="No flashcards found for this document")
 
@@ -601,6 +3330,409 @@ async def get_flashcards(id: str, user_id: str = Depends(get_current_user)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to retrieve flashcards: {str(e)}")
 
+# Concept maps: BERTopic over the chunk embeddings stored at upload, fitted in
+# the background and cached per user until their corpus changes
+concept_maps: "OrderedDict[str, dict]" = OrderedDict()
+concept_map_tasks: Dict[str, asyncio.Task] = {}
+concept_map_semaphore = asyncio.Semaphore(CONCEPT_MAP_CONCURRENCY)
+# UMAP/HDBSCAN (numba, pynndescent) hold the GIL for long stretches, so fits
+# run in their own processes rather than on a thread next to the event loop
+concept_map_executor: Optional[ProcessPoolExecutor] = None
+
+async def corpus_state(conn: asyncpg.Connection, user_id: str) -> Tuple[str, Dict[str, Optional[str]]]:
+    """
+    Fingerprint of a user's documents (ids and content hashes) and the hashes themselves.
+    """
+    rows = await conn.fetch(
+        "SELECT id, content_hash FROM document WHERE user_id = $1 ORDER BY id", uuid.UUID(user_id)
+    )
+    documents = {str(row['id']): row['content_hash'] for row in rows}
+    digest = hashlib.sha256("\n".join(f"{doc_id}:{content_hash}" for doc_id, content_hash in documents.items()).encode("utf-8"))
+    return digest.hexdigest(), documents
+
+async def load_corpus_chunks(conn: asyncpg.Connection, user_id: str, document_ids: Optional[List[str]] = None) -> List[dict]:
+    query = (
+        "SELECT c.chunk_id, c.document_id, d.title, c.content, c.embedding "
+        "FROM document_chunks c JOIN document d ON d.id = c.document_id WHERE c.user_id = $1"
+    )
+    args = [uuid.UUID(user_id)]
+    if document_ids is not None:
+        query += " AND c.document_id = ANY($2::uuid[])"
+        args.append([uuid.UUID(doc_id) for doc_id in document_ids])
+    rows = await conn.fetch(query + " ORDER BY c.document_id, c.chunk_index", *args)
+    return [
+        {
+            "chunk_id": str(row['chunk_id']),
+            "document_id": str(row['document_id']),
+            "title": row['title'],
+            "content": row['content'],
+            "embedding": np.asarray(row['embedding'], dtype=np.float32),
+        }
+        for row in rows
+    ]
+
+def fit_topics(chunks: List[dict]) -> Tuple[object, List[int], List[dict]]:
+    """
+    Fit BERTopic on precomputed embeddings (no re-encoding). Runs inside the
+    concept map process pool. Returns the model, one topic per chunk and the
+    topic hierarchy.
+    """
+    from bertopic import BERTopic
+
+    model = BERTopic(min_topic_size=CONCEPT_MAP_MIN_TOPIC_SIZE, calculate_probabilities=False)
+    docs = [chunk["content"] for chunk in chunks]
+    topics, _ = model.fit_transform(docs, embeddings=np.vstack([chunk["embedding"] for chunk in chunks]))
+    hierarchy = []
+    if len(set(topics) - {-1}) > 1:
+        tree = model.hierarchical_topics(docs)
+        hierarchy = [
+            {
+                "parent_id": int(row.Parent_ID),
+                "parent_name": row.Parent_Name,
+                "children": [int(row.Child_Left_ID), int(row.Child_Right_ID)],
+                "distance": round(float(row.Distance), 4),
+            }
+            for row in tree.itertuples()
+        ]
+    return model, [int(topic) for topic in topics], hierarchy
+
+def assign_topics(model, chunks: List[dict]) -> List[int]:
+    """
+    Place new chunks into the fitted topics without refitting UMAP/HDBSCAN.
+    Runs inside the concept map process pool.
+    """
+    topics, _ = model.transform(
+        [chunk["content"] for chunk in chunks], embeddings=np.vstack([chunk["embedding"] for chunk in chunks])
+    )
+    return [int(topic) for topic in topics]
+
+def summarize_topics(entry: dict) -> dict:
+    model = entry["model"]
+    members: Dict[int, List[dict]] = {}
+    for chunk in entry["chunks"].values():
+        members.setdefault(chunk["topic"], []).append(chunk)
+
+    topics = []
+    for topic_id, chunks in sorted(members.items(), key=lambda item: -len(item[1])):
+        if topic_id == -1:
+            continue
+        keywords = [(word, round(float(score), 4)) for word, score in (model.get_topic(topic_id) or [])[:CONCEPT_MAP_TOP_WORDS]]
+        documents: Dict[str, dict] = {}
+        for chunk in chunks:
+            document = documents.setdefault(chunk["document_id"], {"id": chunk["document_id"], "title": chunk["title"], "chunks": 0})
+            document["chunks"] += 1
+        topics.append({
+            "topic_id": topic_id,
+            "label": model.topic_labels_.get(topic_id) or "_".join(word for word, _ in keywords[:3]),
+            "keywords": keywords,
+            "size": len(chunks),
+            "documents": sorted(documents.values(), key=lambda document: -document["chunks"]),
+        })
+    return {
+        "topics": topics,
+        "hierarchy": entry["hierarchy"],
+        "outliers": len(members.get(-1, [])),
+        "chunks": len(entry["chunks"]),
+        "built_at": entry["built_at"].isoformat(),
+        "fit": entry["fit"],
+    }
+
+async def build_concept_map(user_id: str) -> None:
+    """
+    Bring the user's concept map up to date. Deleted documents are dropped
+    from the topic assignment, small additions are placed into the existing
+    topics, and only larger changes pay for a full UMAP/HDBSCAN refit.
+    """
+    async with concept_map_semaphore:
+        async with db_connection() as conn:
+            fingerprint, documents = await corpus_state(conn, user_id)
+            cached = concept_maps.get(user_id)
+            if cached and cached["fingerprint"] == fingerprint:
+                return
+            # Corpora too small to fit are cached without a model
+            entry = cached if cached and cached.get("model") else None
+            if entry:
+                # Updated documents count as removed and re-added
+                removed = {doc_id for doc_id, content_hash in entry["documents"].items() if documents.get(doc_id) != content_hash}
+                added = [doc_id for doc_id, content_hash in documents.items() if entry["documents"].get(doc_id) != content_hash]
+                new_chunks = await load_corpus_chunks(conn, user_id, added) if added else []
+            else:
+                removed, added = set(), list(documents)
+                new_chunks = await load_corpus_chunks(conn, user_id)
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        if entry:
+            kept = {chunk_id: chunk for chunk_id, chunk in entry["chunks"].items() if chunk["document_id"] not in removed}
+            added_since_fit = entry["added_since_fit"] + len(new_chunks)
+            incremental = bool(kept) and added_since_fit <= entry["fitted_chunks"] * CONCEPT_MAP_REFIT_FRACTION
+        else:
+            kept, added_since_fit, incremental = {}, 0, False
+
+        if incremental:
+            if new_chunks:
+                topics = await loop.run_in_executor(concept_map_executor, assign_topics, entry["model"], new_chunks)
+                for chunk, topic in zip(new_chunks, topics):
+                    kept[chunk["chunk_id"]] = {**chunk, "topic": topic}
+            entry = {**entry, "chunks": kept, "added_since_fit": added_since_fit, "fit": "incremental"}
+        else:
+            chunks = list(kept.values()) + new_chunks
+            if len(chunks) < CONCEPT_MAP_MIN_CHUNKS:
+                concept_maps.pop(user_id, None)
+                concept_maps[user_id] = {"fingerprint": fingerprint, "documents": documents, "result": None}
+                return
+            model, topics, hierarchy = await loop.run_in_executor(concept_map_executor, fit_topics, chunks)
+            entry = {
+                "model": model,
+                "chunks": {chunk["chunk_id"]: {**chunk, "topic": topic} for chunk, topic in zip(chunks, topics)},
+                "hierarchy": hierarchy,
+                "fitted_chunks": len(chunks),
+                "added_since_fit": 0,
+                "fit": "full",
+            }
+        entry.update(fingerprint=fingerprint, documents=documents, built_at=datetime.utcnow())
+        entry["result"] = summarize_topics(entry)
+        record_stage(f"concept_map_{entry['fit']}", time.perf_counter() - started)
+
+        concept_maps.pop(user_id, None)
+        concept_maps[user_id] = entry
+        while len(concept_maps) > CONCEPT_MAP_CACHE_SIZE:
+            concept_maps.popitem(last=False)
+
+def refresh_concept_map(user_id: str) -> None:
+    task = concept_map_tasks.get(user_id)
+    if task and not task.done():
+        return
+    task = asyncio.create_task(build_concept_map(user_id))
+    concept_map_tasks[user_id] = task
+
+    def finished(done: asyncio.Task) -> None:
+        if concept_map_tasks.get(user_id) is done:
+            del concept_map_tasks[user_id]
+        if not done.cancelled() and done.exception():
+            logger.error("Concept map for user %s failed: %s", user_id, done.exception())
+
+    task.add_done_callback(finished)
+
+def start_concept_maps() -> None:
+    global concept_map_executor
+    concept_map_executor = ProcessPoolExecutor(max_workers=CONCEPT_MAP_CONCURRENCY)
+
+async def stop_concept_maps() -> None:
+    for task in concept_map_tasks.values():
+        task.cancel()
+    await asyncio.gather(*concept_map_tasks.values(), return_exceptions=True)
+    concept_map_tasks.clear()
+    if concept_map_executor:
+        concept_map_executor.shutdown(wait=False, cancel_futures=True)
+
+@app.post("/concept-map")
+async def get_concept_map(request: ConceptMapRequest, user_id: str = Depends(get_current_user)):
+    """
+    Topics across the user's documents. The map is built in the background:
+    the first call returns 202 while it fits; after uploads or deletes the
+    previous map is served, marked stale, while it is brought up to date.
+    With `topic_id`, returns that topic and its passages.
+    """
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not initialized")
+
+    try:
+        async with db_connection() as conn:
+            fingerprint, _ = await corpus_state(conn, user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load concept map: {str(e)}")
+
+    entry = concept_maps.get(user_id)
+    stale = entry is None or entry["fingerprint"] != fingerprint
+    if stale:
+        refresh_concept_map(user_id)
+    if entry is None or (stale and entry["result"] is None):
+        return Response(
+            content=json.dumps({"status": "building", "message": "Concept map is being built, please retry shortly."}),
+            media_type="application/json",
+            status_code=status.HTTP_202_ACCEPTED
+        )
+    concept_maps.move_to_end(user_id)
+    result = entry["result"]
+    if result is None:
+        raise HTTPException(status_code=400, detail=f"Concept maps need at least {CONCEPT_MAP_MIN_CHUNKS} passages; upload more documents")
+
+    if request.topic_id is None:
+        return {"status": "refreshing" if stale else "ready", "stale": stale, **result}
+
+    topic = next((topic for topic in result["topics"] if topic["topic_id"] == request.topic_id), None)
+    if not topic:
+        raise HTTPException(status_code=404, detail="Topic not found")
+    passages = [
+        {"document_id": chunk["document_id"], "title": chunk["title"], "content": chunk["content"]}
+        for chunk in entry["chunks"].values() if chunk["topic"] == request.topic_id
+    ]
+    return {"status": "refreshing" if stale else "ready", "stale": stale, **topic, "passages": passages[:CONCEPT_MAP_MAX_PASSAGES]}
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    checks = {"database": pool is not None, "embedding_model": embedder_ready.is_set()}
+    ready = all(checks.values())
+    return Response(
+        content=json.dumps({"status": "ready" if ready else "starting", "checks": checks}),
+        media_type="application/json",
+        status_code=200 if ready else 503
+    )
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus text exposition of the stage, SQL and request histograms plus
+    point-in-time gauges for the pool, queues and caches.
+    """
+    gauges = {
+        "inquiro_ingestion_queue_depth": ingestion_queue.qsize() if ingestion_queue else 0,
+        "inquiro_ingestion_jobs_pending": sum(1 for job in ingestion_jobs.values() if job["status"] not in ("completed", "failed")),
+        "inquiro_query_embedding_queue_depth": query_batcher.queue.qsize() if query_batcher.queue else 0,
+        "inquiro_flashcard_section_cache_entries": len(flashcard_section_cache),
+        "inquiro_bcrypt_pending": bcrypt_pending,
+    }
+    if pool:
+        gauges["inquiro_db_pool_size"] = pool.get_size()
+        gauges["inquiro_db_pool_idle"] = pool.get_idle_size()
+        gauges["inquiro_db_pool_in_use"] = pool.get_size() - pool.get_idle_size()
+        gauges["inquiro_db_pool_max_size"] = pool.get_max_size()
+        gauges["inquiro_db_pool_waiting"] = db_waiting
+    for prefix, stats in (
+        ("query_embedding", query_batcher.stats),
+        ("answer_cache", answer_cache.stats()),
+        ("vector_cache", vector_cache.stats()),
+        ("query_log", query_log.stats()),
+        ("token_cache", token_cache.stats()),
+        ("llm_gateway", llm_gateway.stats()),
+    ):
+        for name, value in stats.items():
+            gauges[f"inquiro_{prefix}_{name}"] = value
+    return Response(content=metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        "query_embedding": query_batcher.stats,
+        "answer_cache": answer_cache.stats(),
+        "vector_cache": vector_cache.stats(),
+        "flashcard_section_cache": {"entries": len(flashcard_section_cache)},
+        "query_log": query_log.stats(),
+        "token_cache": token_cache.stats(),
+        "llm_gateway": llm_gateway.stats(),
+        "concept_maps": {"users": len(concept_maps), "building": len(concept_map_tasks)},
+        "bcrypt": {"pending": bcrypt_pending, "max_pending": BCRYPT_MAX_PENDING, "workers": BCRYPT_WORKERS},
+    }
+
+def serve(workers: int, host: str = "0.0.0.0", port: int = 8000) -> None:
+    """
+    Pre-fork server. The parent prepares the schema and loads the embedding
+    model once, then forks `workers` uvicorn processes sharing one listening
+    socket. The weights are never written after loading, so they stay shared
+    copy-on-write; gc.freeze() keeps the collector from touching (and so
+    copying) the parent's objects. Workers that die are restarted.
+    """
+    import uvicorn
+    global embedder, llm_gateway, SHARED_STATE, INGEST_PROCESSES, OCR_WORKERS
+
+    if workers > 1 and os.getenv("SHARED_STATE") is None:
+        SHARED_STATE = job_mirror.enabled = True
+    # Threads and process pools are per worker: defaults are an even share of
+    # the cores, explicit settings are taken as per-worker values
+    threads = EMBEDDING_THREADS or max(1, (os.cpu_count() or 1) // workers)
+    if os.getenv("INGEST_PROCESSES") is None:
+        INGEST_PROCESSES = max(1, INGEST_PROCESSES // workers)
+    if os.getenv("OCR_WORKERS") is None:
+        OCR_WORKERS = max(1, OCR_WORKERS // workers)
+    # Each worker enforces its share of the Gemini budgets, so upstream sees the configured totals
+    llm_gateway = LLMGateway(
+        LLM_MODEL,
+        max(1, LLM_MAX_CONCURRENCY // workers),
+        max(1, LLM_TOKENS_PER_MINUTE // workers) if LLM_TOKENS_PER_MINUTE > 0 else 0,
+        max(1, LLM_MAX_QUEUE // workers) if LLM_MAX_QUEUE > 0 else 0,
+        LLM_MAX_WAIT_SECONDS,
+    )
+    logger.info(
+        "Per-worker LLM budget: %d concurrent calls, %d tokens/minute, %d queued",
+        llm_gateway.max_concurrency, llm_gateway.tokens_per_minute, llm_gateway.max_queue
+    )
+    asyncio.run(prepare_database())
+    limit_threads(threads)
+    embedder = load_embedder(check=False)
+    listener = socket.create_server((host, port), backlog=2048)
+    gc.freeze()
+
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                uvicorn.Server(uvicorn.Config(app)).run(sockets=[listener])
+            except BaseException:
+                logger.exception("Worker %d crashed", index)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def shutdown(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    for index in range(workers):
+        spawn(index)
+    logger.info(
+        "Serving on %s:%d with %d workers, %d threads, %d parse and %d OCR processes each",
+        host, port, workers, threads, INGEST_PROCESSES, OCR_WORKERS
+    )
+
+    while children:
+        try:
+            pid, wait_status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logger.warning("Worker %d (pid %d) exited with code %d; restarting", index, pid, os.waitstatus_to_exitcode(wait_status))
+        time.sleep(1)
+        spawn(index)
+    listener.close()
+
+logger.info("Imported main in %.2fs", time.perf_counter() - IMPORT_STARTED)
+
 if __name__ == "__main__":
+    command = sys.argv[1:2]
+    if command == ["prefetch"]:
+        prefetch_assets()
+        sys.exit(0)
+    if command == ["export-onnx"]:
+        # python main.py export-onnx <output_dir> [avx2|avx512|avx512_vnni|arm64]
+        export_onnx_int8(*sys.argv[2:4])
+        sys.exit(0)
+    if command == ["parity"]:
+        print(json.dumps(embedding_parity(create_embedder(EMBEDDING_BACKEND)), indent=2))
+        sys.exit(0)
+    if command == ["serve"] or WORKERS > 1:
+        # python main.py serve [workers]
+        serve(int(sys.argv[2]) if command == ["serve"] and len(sys.argv) > 2 else WORKERS)
+        sys.exit(0)
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -36,7 +36,7 @@ const ChatInterface = ({ documents, setSnackbar, handleUnauthorized }) => {
       const token = localStorage.getItem('access_token');
       if (!token) throw new Error('No authentication token found. Please login first.');
 
-      const response = await fetch(`${API_BASE_URL}/query`, {
+      const response = await fetch(`${API_BASE_URL}/query/stream`, {
         method: 'POST',
         headers: {
           'Authorization': `Bearer ${token}`,
@@ -50,22 +50,45 @@ const ChatInterface = ({ documents, setSnackbar, handleUnauthorized }) => {
           throw new Error('Unauthorized: Invalid or expired token');
         }
         const errorData = await response.json();
-        console.log('POST /query error data:', errorData);
+        console.log('POST /query/stream error data:', errorData);
         throw new Error(errorData.detail || 'Query failed');
       }
 
-      const responseData = await response.json();
-      console.log('POST /query response:', responseData);
-      if (!responseData.answer) {
-        throw new Error('Invalid response format: No answer provided');
+      // Render tokens as they arrive over server-sent events
+      const botId = Date.now() + 1;
+      setMessages(prev => [...prev, { id: botId, text: '', sender: 'bot' }]);
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let answer = '';
+      let finished = false;
+
+      while (!finished) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+          if (!event.startsWith('data: ')) continue;
+          const payload = JSON.parse(event.slice(6));
+          if (payload.type === 'token') {
+            answer += payload.text;
+            setMessages(prev => prev.map(msg => (msg.id === botId ? { ...msg, text: answer } : msg)));
+          } else if (payload.type === 'error') {
+            throw new Error(payload.detail || 'Query failed');
+          } else if (payload.type === 'done') {
+            console.log('POST /query/stream done:', payload);
+            finished = true;
+          }
+        }
       }
 
-      const botMessage = {
-        id: Date.now() + 1,
-        text: responseData.answer,
-        sender: 'bot',
-      };
-      setMessages(prev => [...prev, botMessage]);
+      if (!answer) {
+        throw new Error('Invalid response format: No answer provided');
+      }
       setSnackbar({ open: true, message: 'Query answered successfully!', severity: 'success' });
     } catch (error) {
       console.error('Query failed:', error.message);
@@ -20,21 +20,28 @@ const Dashboard = ({ onLogout, handleUnauthorized }) => {
     const fetchDocuments = async () => {
       try {
         const token = localStorage.getItem('access_token');
-        const response = await fetch(`${API_BASE_URL}/documents`, {
-        method: 'GET',
-          headers: {
-            'Authorization': `Bearer ${token}`,
-            'Content-Type': 'application/json'
-          }
-        });
+        // /documents is paginated; follow X-Next-Cursor until the last page
+        let fetchedDocs = [];
+        let cursor = null;
+        do {
+          const url = cursor
+            ? `${API_BASE_URL}/documents?cursor=${encodeURIComponent(cursor)}`
+            : `${API_BASE_URL}/documents`;
+          const response = await fetch(url, {
+            method: 'GET',
+            headers: {
+              'Authorization': `Bearer ${token}`,
+              'Content-Type': 'application/json'
+            }
+          });
 
-        
+          if (!response.ok) break;
+          fetchedDocs = fetchedDocs.concat(await response.json());
+          cursor = response.headers.get('X-Next-Cursor');
+        } while (cursor);
 
-        if (response.ok) {
-          const fetchedDocs = await response.json();
-          console.log('Documents fetched on Dashboard mount:', fetchedDocs);
-          setDocuments(fetchedDocs);
-        }
+        console.log('Documents fetched on Dashboard mount:', fetchedDocs);
+        setDocuments(fetchedDocs);
       } catch (error) {
         console.error('Error fetching documents:', error);
         setSnackbar({ 
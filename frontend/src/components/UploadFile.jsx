@@ -6,7 +6,7 @@ import { Upload } from 'lucide-react';
 const API_BASE_URL = "http://127.0.0.1:8000";
 
 const UploadFile = ({ onFileUpload, onDocumentsFetched, setSnackbar, handleUnauthorized }) => {
-  const [file, setFile] = useState(null);
+  const [files, setFiles] = useState([]);
   const [uploading, setUploading] = useState(false);
   const [documents, setDocuments] = useState([]);
   const navigate = useNavigate();
@@ -61,12 +61,95 @@ const UploadFile = ({ onFileUpload, onDocumentsFetched, setSnackbar, handleUnaut
     }
   };
 
+  const waitForJob = async (jobId, token) => {
+    // Uploads are processed in the background; poll until the job settles
+    while (true) {
+      const response = await fetch(`${API_BASE_URL}/jobs/${jobId}`, {
+        method: 'GET',
+        headers: {
+          'Authorization': `Bearer ${token}`,
+        },
+      });
+
+      if (!response.ok) {
+        if (response.status === 401) {
+          throw new Error('Unauthorized: Invalid or expired token');
+        }
+        const errorData = await response.json();
+        throw new Error(errorData.detail || 'Failed to fetch upload status');
+      }
+
+      const job = await response.json();
+      if (job.status === 'completed') return job;
+      if (job.status === 'failed') throw new Error(job.error || 'File processing failed');
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+  };
+
   const handleFileChange = (event) => {
-    setFile(event.target.files[0]);
+    setFiles(Array.from(event.target.files));
+  };
+
+  const addDocument = (newDoc) => {
+    setDocuments(prev => [...prev, newDoc]);
+    if (typeof onFileUpload === 'function') {
+      onFileUpload(newDoc);
+    } else {
+      console.warn('onFileUpload is not a function, skipping');
+    }
+  };
+
+  const uploadBatch = async (token) => {
+    const formData = new FormData();
+    files.forEach(selected => formData.append('files', selected));
+
+    console.log('Uploading files:', files.map(selected => selected.name));
+    const response = await fetch(`${API_BASE_URL}/upload/batch`, {
+      method: 'POST',
+      headers: {
+        'Authorization': `Bearer ${token}`,
+      },
+      body: formData,
+    });
+
+    if (!response.ok) {
+      if (response.status === 401) {
+        throw new Error('Unauthorized: Invalid or expired token');
+      }
+      const errorData = await response.json();
+      console.log('POST /upload/batch error data:', errorData);
+      throw new Error(errorData.detail || 'File upload failed');
+    }
+
+    const result = await response.json();
+    console.log('POST /upload/batch response:', result);
+    const failures = result.files
+      .filter(entry => entry.status === 'rejected')
+      .map(entry => `${entry.filename}: ${entry.error}`);
+    const accepted = result.files.filter(entry => entry.job_id);
+    const outcomes = await Promise.allSettled(accepted.map(entry => waitForJob(entry.job_id, token)));
+    outcomes.forEach((outcome, index) => {
+      if (outcome.status === 'fulfilled') {
+        addDocument({ id: outcome.value.document_id, title: accepted[index].filename });
+      } else if (outcome.reason.message.includes('Unauthorized')) {
+        throw outcome.reason;
+      } else {
+        failures.push(`${accepted[index].filename}: ${outcome.reason.message}`);
+      }
+    });
+
+    const uploaded = outcomes.filter(outcome => outcome.status === 'fulfilled').length;
+    setSnackbar({
+      open: true,
+      message: failures.length
+        ? `Uploaded ${uploaded} of ${result.files.length} files. ${failures.join('; ')}`
+        : `Uploaded ${result.files.length} files`,
+      severity: failures.length ? 'warning' : 'success',
+    });
   };
 
   const handleUpload = async () => {
-    if (!file) {
+    if (!files.length) {
       setSnackbar({ open: true, message: 'Please select a file to upload', severity: 'error' });
       return;
     }
@@ -76,6 +159,14 @@ const UploadFile = ({ onFileUpload, onDocumentsFetched, setSnackbar, handleUnaut
       const token = localStorage.getItem('access_token');
       if (!token) throw new Error('No authentication token found. Please login first.');
 
+      if (files.length > 1) {
+        await uploadBatch(token);
+        setFiles([]);
+        setUploading(false);
+        return;
+      }
+
+      const file = files[0];
       const formData = new FormData();
       formData.append('file', file);
 
@@ -99,14 +190,9 @@ const UploadFile = ({ onFileUpload, onDocumentsFetched, setSnackbar, handleUnaut
 
       const result = await response.json();
       console.log('POST /upload response:', result);
-      const newDoc = { id: result.id, title: file.name };
-      setDocuments(prev => [...prev, newDoc]);
-      if (typeof onFileUpload === 'function') {
-        onFileUpload(newDoc);
-      } else {
-        console.warn('onFileUpload is not a function, skipping');
-      }
-      setFile(null);
+      const job = await waitForJob(result.job_id, token);
+      addDocument({ id: job.document_id, title: file.name });
+      setFiles([]);
     } catch (error) {
       console.error('Upload failed:', error.message);
       if (error.message.includes('Unauthorized')) {
@@ -145,6 +231,7 @@ const UploadFile = ({ onFileUpload, onDocumentsFetched, setSnackbar, handleUnaut
           type="file"
           accept=".pdf,.docx,.txt"
           onChange={handleFileChange}
+          multiple
           style={{ display: 'none' }}
           id="file-upload"
           disabled={uploading}
@@ -156,19 +243,19 @@ const UploadFile = ({ onFileUpload, onDocumentsFetched, setSnackbar, handleUnaut
             disabled={uploading}
             startIcon={uploading ? <CircularProgress size={20} /> : <Upload size={16} />}
           >
-            {uploading ? 'Uploading...' : 'Choose File'}
+            {uploading ? 'Uploading...' : 'Choose Files'}
           </Button>
         </label>
-        {file && (
+        {files.length > 0 && (
           <Typography variant="body2" sx={{ color: 'text.primary', mt: 2 }}>
-            Selected: {file.name}
+            Selected: {files.length === 1 ? files[0].name : `${files.length} files`}
           </Typography>
         )}
-        {file && (
+        {files.length > 0 && (
         <Button
           variant="contained"
           onClick={handleUpload}
-          disabled={uploading || !file}
+          disabled={uploading || !files.length}
           sx={{ mt: 2 }}
         >
           Upload